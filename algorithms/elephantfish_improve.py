@@ -1370,6 +1370,12 @@ MATE_UPPER = piece["K"] + (
 TABLE_SIZE = 1e7
 
 # Constants for tuning search
+# Deeper than the recursion limit allows, used to size the PV table
+MAX_PLY = 1000
+# Nodes between two checks of Searcher.cancel_token
+CHECK_NODES = 1024
+# Longest line kept in the table of lines
+MAX_PV = 32
 QS_LIMIT = 219
 EVAL_ROUGHNESS = 2
 DRAW_TEST = True
@@ -1487,18 +1493,41 @@ class Position(namedtuple("Position", "board score")):
 Entry = namedtuple("Entry", "lower upper")
 
 
+class SearchAborted(Exception):
+    """Raised inside the search when its cancel_token has been cancelled"""
+
+
 class Searcher:
     def __init__(self):
         self.tp_score = {}
         self.tp_move = {}
         self.history = set()
         self.nodes = 0
+        # An object with a cancelled attribute, e.g. elephantfish.CancelToken,
+        # checked every CHECK_NODES nodes
+        self.cancel_token = None
+        # Triangular PV table: pv_table[ply] is the best line found from the node
+        # at that ply. Nodes cut off by the table take the line stored with their
+        # killer move in tp_pv. pv is the line of the last depth search() yielded.
+        self.pv_table = [()] * MAX_PLY
+        self.tp_pv = {}
+        self.pv = ()
 
-    def bound(self, pos, gamma, depth, root=True):
+    def bound(self, pos, gamma, depth, root=True, ply=0):
         """returns r where
         s(pos) <= r < gamma    if gamma > s(pos)
-        gamma <= r <= s(pos)   if gamma <= s(pos)"""
+        gamma <= r <= s(pos)   if gamma <= s(pos)
+        and sets pv_table[ply] to the line that gave r"""
         self.nodes += 1
+        if (
+            self.cancel_token is not None
+            and self.nodes % CHECK_NODES == 0
+            and self.cancel_token.cancelled
+        ):
+            raise SearchAborted
+        # Nodes that return early, e.g. from the table, end the line here
+        pv_table = self.pv_table
+        pv_table[ply] = ()
 
         # Depth <= 0 is QSearch. Here any position is searched as deeply as is needed for
         # calmness, and from this point on there is no difference in behaviour depending on
@@ -1528,8 +1557,10 @@ class Searcher:
         # nodes as the current search.
         entry = self.tp_score.get((pos, depth, root), Entry(-MATE_UPPER, MATE_UPPER))
         if entry.lower >= gamma and (not root or self.tp_move.get(pos) is not None):
+            pv_table[ply] = self.tp_pv.get(pos, ())
             return entry.lower
         if entry.upper < gamma:
+            pv_table[ply] = self.tp_pv.get(pos, ())
             return entry.upper
 
         # Here extensions may be added
@@ -1542,7 +1573,7 @@ class Searcher:
             # piece left on the board, since otherwise zugzwangs are too dangerous.
             if depth > 0 and not root and any(c in pos.board for c in "RNC"):
                 yield None, -self.bound(
-                    pos.nullmove(), 1 - gamma, depth - 3, root=False
+                    pos.nullmove(), 1 - gamma, depth - 3, root=False, ply=ply + 1
                 )
             # For QSearch we have a different kind of null-move, namely we can just stop
             # and not capture anythign else.
@@ -1555,7 +1586,7 @@ class Searcher:
             killer = self.tp_move.get(pos)
             if killer and (depth > 0 or pos.value(killer) >= QS_LIMIT):
                 yield killer, -self.bound(
-                    pos.move(killer), 1 - gamma, depth - 1, root=False
+                    pos.move(killer), 1 - gamma, depth - 1, root=False, ply=ply + 1
                 )
             # Then all the other moves
             for move in sorted(pos.gen_moves(), key=pos.value, reverse=True):
@@ -1564,19 +1595,31 @@ class Searcher:
                 # promotions). Otherwise we do all moves.
                 if depth > 0 or pos.value(move) >= QS_LIMIT:
                     yield move, -self.bound(
-                        pos.move(move), 1 - gamma, depth - 1, root=False
+                        pos.move(move), 1 - gamma, depth - 1, root=False, ply=ply + 1
                     )
 
-        # Run through the moves, shortcutting when possible
-        best = -MATE_UPPER
+        # Run through the moves, shortcutting when possible. The line follows the
+        # best real move; the child's line is still in pv_table[ply + 1] right
+        # after it returned.
+        best = line_score = -MATE_UPPER
+        line = ()
         for move, score in moves():
             best = max(best, score)
+            if move is not None and score > line_score:
+                line_score = score
+                line = (move,) + pv_table[ply + 1]
             if best >= gamma:
                 # Clear before setting, so we always have a value
                 if len(self.tp_move) > TABLE_SIZE:
                     self.tp_move.clear()
+                    self.tp_pv.clear()
                 # Save the move for pv construction and killer heuristic
                 self.tp_move[pos] = move
+                # and its line, for nodes that later return from the table
+                if move is not None:
+                    if len(line) > MAX_PV:
+                        line = line[:MAX_PV]
+                    self.tp_pv[pos] = line
                 break
 
         # Stalemate checking is a bit tricky: Say we failed low, because
@@ -1596,6 +1639,14 @@ class Searcher:
             if all(is_dead(pos.move(m)) for m in pos.gen_moves()):
                 in_check = is_dead(pos.nullmove())
                 best = -MATE_UPPER if in_check else 0
+                line = ()
+        if depth == 0 and best > line_score:
+            # Standing pat in QSearch ends the line
+            line = ()
+        elif not line and depth > 0:
+            # Cut off by the null move, keep the line of an earlier search
+            line = self.tp_pv.get(pos, ())
+        pv_table[ply] = line
 
         # Clear before setting, so we always have a value
         if len(self.tp_score) > TABLE_SIZE:
@@ -1619,26 +1670,39 @@ class Searcher:
         # In finished games, we could potentially go far enough to cause a recursion
         # limit exception. Hence we bound the ply.
         for depth in range(1, 1000):
-            # The inner loop is a binary search on the score of the position.
-            # Inv: lower <= score <= upper
-            # 'while lower != upper' would work, but play tests show a margin of 20 plays
-            # better.
-            lower, upper = -MATE_UPPER, MATE_UPPER
-            while lower < upper - EVAL_ROUGHNESS:
-                gamma = (lower + upper + 1) // 2
-                score = self.bound(pos, gamma, depth)
-                if score >= gamma:
-                    lower = score
-                if score < gamma:
-                    upper = score
-            # We want to make sure the move to play hasn't been kicked out of the table,
-            # So we make another call that must always fail high and thus produce a move.
-            self.bound(pos, lower, depth)
-            # If the game hasn't finished we can retrieve our move from the
-            # transposition table.
-            yield depth, self.tp_move.get(pos), self.tp_score.get(
+            try:
+                # The inner loop is a binary search on the score of the position.
+                # Inv: lower <= score <= upper
+                # 'while lower != upper' would work, but play tests show a margin of
+                # 20 plays better.
+                lower, upper = -MATE_UPPER, MATE_UPPER
+                # The line of the last search that failed high, see elephantfish._mtd
+                pv = ()
+                while lower < upper - EVAL_ROUGHNESS:
+                    gamma = (lower + upper + 1) // 2
+                    score = self.bound(pos, gamma, depth)
+                    if score >= gamma:
+                        lower = score
+                        pv = self.pv_table[0] or pv
+                    if score < gamma:
+                        upper = score
+                # We want to make sure the move to play hasn't been kicked out of the
+                # table, so we make another call that must always fail high and thus
+                # produce a move.
+                self.bound(pos, lower, depth)
+                pv = self.pv_table[0] or pv
+                # If the game hasn't finished we can retrieve our move from the
+                # transposition table.
+                move = self.tp_move.get(pos)
+                if not pv or pv[0] != move:
+                    pv = () if move is None else (move,)
+                self.pv = pv
+            except SearchAborted:
+                # The result of the last finished depth stands
+                return
+            yield depth, move, self.tp_score.get(
                 (pos, depth, True), Entry(-MATE_UPPER, MATE_UPPER)
-            ).lower
+            ).lower, pv
 
 
 ###############################################################################
@@ -1715,7 +1779,7 @@ def main():
 
         # Fire up the engine to look for a move.
         start = time.time()
-        for _depth, move, score in searcher.search(hist[-1], hist):
+        for _depth, move, score, _pv in searcher.search(hist[-1], hist):
             if time.time() - start > THINK_TIME:
                 break
 
@@ -1370,6 +1370,10 @@ MATE_UPPER = piece["K"] + (
 TABLE_SIZE = 1e7
 
 # Constants for tuning search
+# Deeper than the recursion limit allows, used to size the PV table
+MAX_PLY = 1000
+# Nodes between two checks of Searcher.cancel_token
+CHECK_NODES = 1024
 QS_LIMIT = 219
 EVAL_ROUGHNESS = 13
 DRAW_TEST = True
@@ -1487,18 +1491,39 @@ class Position(namedtuple("Position", "board score")):
 Entry = namedtuple("Entry", "lower upper")
 
 
+class SearchAborted(Exception):
+    """Raised inside the search when its cancel_token has been cancelled"""
+
+
 class Searcher:
     def __init__(self):
         self.tp_score = {}
         self.tp_move = {}
         self.history = set()
         self.nodes = 0
+        # An object with a cancelled attribute, e.g. elephantfish.CancelToken,
+        # checked every CHECK_NODES nodes
+        self.cancel_token = None
+        # Triangular PV table: pv_table[ply] is the best line found from the node
+        # at that ply. pv is the line of the last depth search() yielded.
+        self.pv_table = [()] * MAX_PLY
+        self.pv = ()
 
-    def alphabet(self, pos, alpha, beta, depth, root=True):
+    def alphabet(self, pos, alpha, beta, depth, root=True, ply=0):
         """returns r where
         s(pos) <= r < gamma    if gamma > s(pos)
-        gamma <= r <= s(pos)   if gamma <= s(pos)"""
+        gamma <= r <= s(pos)   if gamma <= s(pos)
+        and sets pv_table[ply] to the line that raised alpha"""
         self.nodes += 1
+        if (
+            self.cancel_token is not None
+            and self.nodes % CHECK_NODES == 0
+            and self.cancel_token.cancelled
+        ):
+            raise SearchAborted
+        # Nodes that return early end the line here
+        pv_table = self.pv_table
+        pv_table[ply] = ()
 
         # Depth <= 0 is QSearch. Here any position is searched as deeply as is needed for
         # calmness, and from this point on there is no difference in behaviour depending on
@@ -1540,8 +1565,12 @@ class Searcher:
         # First try not moving at all. We only do this if there is at least one major
         # piece left on the board, since otherwise zugzwangs are too dangerous.
         if depth > 0 and not root and any(c in pos.board for c in "RNC"):
-            val = -self.alphabet(pos.nullmove(), -beta, 1 - beta, depth - 3, root=False)
-            if val >= beta and self.alphabet(pos, alpha, beta, depth - 3, root=False):
+            val = -self.alphabet(
+                pos.nullmove(), -beta, 1 - beta, depth - 3, root=False, ply=ply + 1
+            )
+            if val >= beta and self.alphabet(
+                pos, alpha, beta, depth - 3, root=False, ply=ply
+            ):
                 return val
         # For QSearch we have a different kind of null-move, namely we can just stop
         # and not capture anythign else.
@@ -1563,15 +1592,30 @@ class Searcher:
             if (move is not None) and (depth > 0):
                 if best == -MATE_UPPER:
                     val = -self.alphabet(
-                        pos.move(move), -beta, -alpha, depth - 1, root=False
+                        pos.move(move),
+                        -beta,
+                        -alpha,
+                        depth - 1,
+                        root=False,
+                        ply=ply + 1,
                     )
                 else:
                     val = -self.alphabet(
-                        pos.move(move), -alpha - 1, -alpha, depth - 1, root=False
+                        pos.move(move),
+                        -alpha - 1,
+                        -alpha,
+                        depth - 1,
+                        root=False,
+                        ply=ply + 1,
                     )
                     if val > alpha and val < beta:
                         val = -self.alphabet(
-                            pos.move(move), -beta, -alpha, depth - 1, root=False
+                            pos.move(move),
+                            -beta,
+                            -alpha,
+                            depth - 1,
+                            root=False,
+                            ply=ply + 1,
                         )
                 if val > best:
                     best = val
@@ -1581,6 +1625,8 @@ class Searcher:
                     if val > alpha:
                         alpha = val
                         mvBest = move
+                        # The child's line is still in pv_table[ply + 1]
+                        pv_table[ply] = (move,) + pv_table[ply + 1]
         if mvBest is not None:
             # Clear before setting, so we always have a value
             # Save the move for pv construction and killer heuristic
@@ -1628,15 +1674,24 @@ class Searcher:
         # In finished games, we could potentially go far enough to cause a recursion
         # limit exception. Hence we bound the ply.
         for depth in range(1, 1000):
-            # The inner loop is a binary search on the score of the position.
-            # Inv: lower <= score <= upper
-            # 'while lower != upper' would work, but play tests show a margin of 20 plays
-            # better.
-            lower, upper = -MATE_UPPER, MATE_UPPER
-            self.alphabet(pos, lower, upper, depth)
-            yield depth, self.tp_move.get(pos), self.tp_score.get(
+            try:
+                # The inner loop is a binary search on the score of the position.
+                # Inv: lower <= score <= upper
+                # 'while lower != upper' would work, but play tests show a margin of
+                # 20 plays better.
+                lower, upper = -MATE_UPPER, MATE_UPPER
+                self.alphabet(pos, lower, upper, depth)
+                move = self.tp_move.get(pos)
+                pv = self.pv_table[0]
+                if not pv or pv[0] != move:
+                    pv = () if move is None else (move,)
+                self.pv = pv
+            except SearchAborted:
+                # The result of the last finished depth stands
+                return
+            yield depth, move, self.tp_score.get(
                 (pos, depth, True), Entry(-MATE_UPPER, MATE_UPPER)
-            ).lower
+            ).lower, pv
 
 
 ###############################################################################
@@ -1713,7 +1768,7 @@ def main():
 
         # Fire up the engine to look for a move.
         start = time.time()
-        for _depth, move, score in searcher.search(hist[-1], hist):
+        for _depth, move, score, _pv in searcher.search(hist[-1], hist):
             if time.time() - start > THINK_TIME:
                 break
 
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+batch.py: 用 NumPy 批量处理局面
+
+分析和调参时要处理成千上万个局面，逐个调用 `tools.parseFEN` 太慢。这里把局面编码成
+`(N, 256)` 的 int8 数组，一次算出全部局面的子力价值表得分和子力数量：
+
+    codes, colors = batch.load_fens("data/fen/random_openings.fen")
+    scores = batch.pst_scores(codes)
+    counts = batch.material(codes)
+
+编码和 elephantfish 的棋盘一致：数组的第 i 列就是 `Position.board[i]`，总是从轮到走棋的
+一方看，大写（己方）棋子编码为 1..7，小写（对方）棋子为 -1..-7，空格和棋盘外为 0，
+棋子顺序见 `PIECES`。`pst_scores` 只包含子力价值表的部分，
+等于 `elephantfish.evaluate` 不算王的安全、过河兵等附加项（`EVAL_TERMS`）时的值。
+
+需要安装 numpy：
+
+    pip install numpy
+
+author: wzpan
+email: m@hahack.com
+"""
+
+from typing import Iterable, Iterator, Optional, Sequence, Tuple
+
+import numpy as np
+
+import elephantfish
+from elephantfish import pst
+
+# 编码 1..7 对应的棋子
+PIECES = "PNBARCK"
+# material() 返回的列
+MATERIAL_COLUMNS = PIECES + PIECES.lower()
+
+# 字符到编码的查找表
+_CODES = np.zeros(256, dtype=np.int8)
+for _code, _p in enumerate(PIECES, 1):
+    _CODES[ord(_p)] = _code
+    _CODES[ord(_p.lower())] = -_code
+
+# 棋盘上 90 个格子在 256 个字符中的下标，按 FEN 的顺序（从黑方底线开始）
+BOARD_SQUARES = np.array(
+    [elephantfish.A9 + 16 * rank + fil for rank in range(10) for fil in range(9)]
+)
+# 每个格子对方视角的对称格子，与 Position.rotate() 一致
+_MIRROR = (254 - np.arange(256)) % 256
+# FEN 棋盘部分展开数字以后去掉 "/"，得到 90 个字符
+_EXPAND = str.maketrans({str(n): "." * n for n in range(1, 10)} | {"/": None})
+
+
+def default_tables() -> np.ndarray:
+    """
+    elephantfish 当前的子力价值表
+
+    :return: `(8, 256)` 的 int32 数组，第 k 行是编码为 k 的棋子的表，第 0 行为 0
+    """
+    tables = np.zeros((8, 256), dtype=np.int32)
+    for code, p in enumerate(PIECES, 1):
+        tables[code] = pst[p]
+    return tables
+
+
+def encode_boards(boards: Sequence[str]) -> np.ndarray:
+    """
+    把 elephantfish 的棋盘字符串编码成数组
+
+    :param boards: `Position.board` 的序列
+    :return: `(N, 256)` 的 int8 数组
+    """
+    if not boards:
+        return np.zeros((0, 256), dtype=np.int8)
+    raw = np.frombuffer("".join(boards).encode("ascii"), dtype=np.uint8)
+    return _CODES[raw.reshape(len(boards), 256)]
+
+
+def parse_fens(fens: Iterable[str]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    批量解析 FEN，结果与逐个调用 `tools.parseFEN` 的棋盘一致
+
+    :param fens: FEN 字符串
+    :return: (codes, colors)。codes 是 `(N, 256)` 的 int8 数组，
+        colors 是 `(N,)` 的 int8 数组，0 表示红方走棋，1 表示黑方走棋
+    """
+    rows, colors = [], []
+    for fen in fens:
+        board, color = fen.split(None, 2)[:2]
+        rows.append(board.translate(_EXPAND))
+        colors.append(color != "w")
+    colors = np.array(colors, dtype=np.int8)
+    codes = np.zeros((len(rows), 256), dtype=np.int8)
+    if not rows:
+        return codes, colors
+    raw = np.frombuffer("".join(rows).encode("ascii"), dtype=np.uint8)
+    if raw.size != 90 * len(rows):
+        raise ValueError("FEN 的棋盘部分必须正好有 90 个格子")
+    squares = _CODES[raw.reshape(len(rows), 90)]
+    # 黑方走棋时棋盘旋转 180 度并交换双方，与 Position.rotate() 一致
+    black = colors == 1
+    squares[black] = -squares[black, ::-1]
+    codes[:, BOARD_SQUARES] = squares
+    return codes, colors
+
+
+def iter_fen_batches(
+    path: str, batch_size: int = 65536
+) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+    """
+    分批读取 FEN 文件，每行一个 FEN，内存占用与文件大小无关
+
+    :param path: FEN 文件路径
+    :param batch_size: 每批的局面数
+    :return: 依次产生 parse_fens 的结果
+    """
+    with open(path) as f:
+        lines = []
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                lines.append(line)
+                if len(lines) >= batch_size:
+                    yield parse_fens(lines)
+                    lines = []
+        if lines:
+            yield parse_fens(lines)
+
+
+def load_fens(path: str) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    读取整个 FEN 文件
+
+    :return: parse_fens 的结果
+    """
+    batches = list(iter_fen_batches(path))
+    if not batches:
+        return parse_fens([])
+    codes, colors = zip(*batches)
+    return np.concatenate(codes), np.concatenate(colors)
+
+
+def pst_scores(codes: np.ndarray, tables: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    子力价值表得分，从轮到走棋的一方看，与 `Position.score` 的计算方式相同
+
+    :param codes: `(N, 256)` 的编码
+    :param tables: `(8, 256)` 的子力价值表，默认为 elephantfish 当前的表
+    :return: `(N,)` 的 int32 数组
+    """
+    if tables is None:
+        tables = default_tables()
+    # 只看棋盘上的 90 个格子，对方的棋子按己方视角的对称格子 254 - i 查表
+    squares = codes[:, BOARD_SQUARES]
+    ours = tables[np.maximum(squares, 0), BOARD_SQUARES]
+    theirs = tables[np.maximum(-squares, 0), _MIRROR[BOARD_SQUARES]]
+    return (ours - theirs).sum(axis=1, dtype=np.int32)
+
+
+def material(codes: np.ndarray) -> np.ndarray:
+    """
+    每个局面双方各种棋子的数量
+
+    :param codes: `(N, 256)` 的编码
+    :return: `(N, 14)` 的 int16 数组，列的顺序见 `MATERIAL_COLUMNS`
+    """
+    n = len(codes)
+    offsets = (np.arange(n) * 15)[:, None]
+    squares = codes[:, BOARD_SQUARES].astype(np.int64)
+    counts = np.bincount((squares + 7 + offsets).ravel(), minlength=15 * n)
+    counts = counts.reshape(n, 15).astype(np.int16)
+    # 第 0..6 列是编码 -7..-1，第 8..14 列是编码 1..7
+    return np.concatenate([counts[:, 8:], counts[:, 6::-1]], axis=1)
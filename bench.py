@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+bench.py: 引擎基准测试
+
+    python bench.py levels [--positions 20]
+
+levels: 对每个难度等级，在 random_openings.fen 的前若干个局面上各搜索一次，
+报告平均节点数、耗时和 NPS。节点数与机器无关，可以用于容量规划；
+每个等级会搜索两遍，检查结果是否完全一致。
+
+    python bench.py batch [--positions 100000]
+
+batch: 比较逐个调用 tools.parseFEN 和用 batch.py 批量解析、计算子力价值表得分的速度。
+
+    python bench.py fen [--positions 200000] [--workers 4]
+
+fen: 把 random_openings.fen 复制到指定的局面数，比较逐行读取、fen.iter_positions
+单进程和多进程解析的速度，以及 fen.render 的速度。
+
+    python bench.py multipv [--lines 3] [--depth 4] [--positions 20]
+
+multipv: 在同样的深度下搜索 1 到 lines 条最佳着法，报告节点数和耗时相对于只搜一条的倍数。
+
+    python bench.py replay data/games [--level 普通] [--positions 200]
+
+replay: 回放 gamelog.py 记录的棋谱，在实际对局出现过的局面上按难度等级搜索，
+报告平均节点数、耗时和 NPS，比开局局面更接近线上的负载。
+
+author: wzpan
+email: m@hahack.com
+"""
+import argparse
+import os
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+FEN_FILE = os.path.join(HERE, "data", "fen", "random_openings.fen")
+
+
+def load_positions(path, limit):
+    import tools
+
+    with open(path) as f:
+        fens = [line.strip() for line in f if line.strip()]
+    return [tools.parseFEN(fen) for fen in fens[:limit]]
+
+
+def bench_levels(args):
+    import elephantfish
+    from chess import LEVELS
+
+    positions = load_positions(args.fen, args.positions)
+    print(
+        "{:<6} {:>8} {:>6} {:>10} {:>9} {:>10} {:>6}".format(
+            "level", "nodes", "depth", "max nodes", "ms", "nps", "same"
+        )
+    )
+    for level in LEVELS.values():
+        results = []
+        for _ in range(2):
+            nodes = depths = peak = 0
+            moves = []
+            start = time.perf_counter()
+            for pos in positions:
+                searcher = elephantfish.Searcher()
+                for depth, move, score, _pv in searcher.search(
+                    pos, (), level.nodes, level.depth
+                ):
+                    pass
+                nodes += searcher.nodes
+                depths += depth
+                peak = max(peak, searcher.nodes)
+                moves.append((move, score))
+            elapsed = time.perf_counter() - start
+            results.append((nodes, depths, peak, elapsed, moves))
+        nodes, depths, peak, elapsed, moves = results[0]
+        same = results[0][:3] == results[1][:3] and moves == results[1][4]
+        n = len(positions)
+        print(
+            "{:<6} {:>8.0f} {:>6.1f} {:>10} {:>9.1f} {:>10.0f} {:>6}".format(
+                level.name,
+                nodes / n,
+                depths / n,
+                peak,
+                elapsed / n * 1000,
+                nodes / elapsed,
+                "yes" if same else "NO",
+            )
+        )
+
+
+def bench_batch(args):
+    import batch
+    import tools
+
+    with open(args.fen) as f:
+        fens = [line.strip() for line in f if line.strip()]
+    fens = (fens * (args.positions // len(fens) + 1))[: args.positions]
+
+    start = time.perf_counter()
+    scores = [tools.parseFEN(fen).score for fen in fens]
+    single = time.perf_counter() - start
+
+    start = time.perf_counter()
+    codes, _ = batch.parse_fens(fens)
+    batch.pst_scores(codes)
+    batch.material(codes)
+    vectorized = time.perf_counter() - start
+
+    print("{} positions".format(len(scores)))
+    print("tools.parseFEN  {:>8.2f} us/position".format(single / len(fens) * 1e6))
+    print("batch           {:>8.2f} us/position".format(vectorized / len(fens) * 1e6))
+
+
+def bench_fen(args):
+    import tempfile
+
+    import fen
+
+    with open(args.fen) as f:
+        fens = [line.strip() for line in f if line.strip()]
+    fens = (fens * (args.positions // len(fens) + 1))[: args.positions]
+    with tempfile.NamedTemporaryFile("w", suffix=".fen", delete=False) as f:
+        f.writelines(line + "\n" for line in fens)
+        path = f.name
+    try:
+        start = time.perf_counter()
+        with open(path) as f:
+            positions = [fen.parse(line) for line in f if line.strip()]
+        readlines = time.perf_counter() - start
+
+        start = time.perf_counter()
+        count = sum(1 for _ in fen.iter_positions(path, workers=1))
+        streaming = time.perf_counter() - start
+        assert count == len(positions)
+
+        start = time.perf_counter()
+        count = sum(1 for _ in fen.iter_positions(path, workers=args.workers))
+        pooled = time.perf_counter() - start
+        assert count == len(positions)
+
+        start = time.perf_counter()
+        for pos in positions:
+            fen.render(pos)
+        render = time.perf_counter() - start
+    finally:
+        os.remove(path)
+
+    n = len(positions)
+    print("{} positions".format(n))
+    print("readline + fen.parse    {:>8.2f} us/position".format(readlines / n * 1e6))
+    print("iter_positions          {:>8.2f} us/position".format(streaming / n * 1e6))
+    print(
+        "iter_positions({} proc)  {:>8.2f} us/position".format(
+            args.workers or os.cpu_count(), pooled / n * 1e6
+        )
+    )
+    print("fen.render              {:>8.2f} us/position".format(render / n * 1e6))
+
+
+def bench_multipv(args):
+    import elephantfish
+
+    positions = load_positions(args.fen, args.positions)
+    print(
+        "{:<6} {:>8} {:>9} {:>7} {:>7}".format(
+            "lines", "nodes", "ms", "nodes×", "time×"
+        )
+    )
+    base = None
+    for lines in range(1, args.lines + 1):
+        nodes = 0
+        start = time.perf_counter()
+        for pos in positions:
+            searcher = elephantfish.Searcher()
+            if lines == 1:
+                for _ in searcher.search(pos, (), None, args.depth):
+                    pass
+            else:
+                for _ in searcher.search_multipv(pos, (), lines, None, args.depth):
+                    pass
+            nodes += searcher.nodes
+        elapsed = time.perf_counter() - start
+        if base is None:
+            base = nodes, elapsed
+        n = len(positions)
+        print(
+            "{:<6} {:>8.0f} {:>9.1f} {:>7.2f} {:>7.2f}".format(
+                lines,
+                nodes / n,
+                elapsed / n * 1000,
+                nodes / base[0],
+                elapsed / base[1],
+            )
+        )
+
+
+def bench_replay(args):
+    import elephantfish
+    import gamelog
+    from chess import LEVELS
+
+    level = LEVELS[args.level]
+    positions = []
+    for game in gamelog.iter_games(args.paths):
+        for pos, _move in game.replay():
+            positions.append(pos)
+        if len(positions) >= args.positions:
+            break
+    positions = positions[: args.positions]
+    if not positions:
+        raise SystemExit("没有读到棋谱")
+    nodes = depths = 0
+    start = time.perf_counter()
+    for pos in positions:
+        searcher = elephantfish.Searcher()
+        for depth, *_ in searcher.search(pos, (), level.nodes, level.depth):
+            pass
+        nodes += searcher.nodes
+        depths += depth
+    elapsed = time.perf_counter() - start
+    n = len(positions)
+    print(
+        "{} positions, level {}: {:.0f} nodes, depth {:.1f}, {:.1f} ms, {:.0f} nps".format(
+            n, level.name, nodes / n, depths / n, elapsed / n * 1000, nodes / elapsed
+        )
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="引擎基准测试")
+    parser.add_argument("--fen", default=FEN_FILE, help="局面文件")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    levels = subparsers.add_parser("levels", help="各难度等级的计算量")
+    levels.add_argument("--positions", type=int, default=20, help="测试的局面数")
+    levels.set_defaults(func=bench_levels)
+
+    batches = subparsers.add_parser("batch", help="批量解析和评估 FEN 的速度")
+    batches.add_argument("--positions", type=int, default=100000, help="局面数")
+    batches.set_defaults(func=bench_batch)
+
+    fens = subparsers.add_parser("fen", help="读写 FEN 文件的速度")
+    fens.add_argument("--positions", type=int, default=200000, help="局面数")
+    fens.add_argument("--workers", type=int, default=None, help="进程数")
+    fens.set_defaults(func=bench_fen)
+
+    multipv = subparsers.add_parser("multipv", help="多条最佳着法的额外开销")
+    multipv.add_argument("--lines", type=int, default=3, help="最多搜索的着法数")
+    multipv.add_argument("--depth", type=int, default=4, help="搜索深度")
+    multipv.add_argument("--positions", type=int, default=20, help="测试的局面数")
+    multipv.set_defaults(func=bench_multipv)
+
+    replay = subparsers.add_parser("replay", help="在棋谱中的局面上搜索")
+    replay.add_argument("paths", nargs="+", help="棋谱文件或目录")
+    replay.add_argument("--level", default="普通", help="难度等级")
+    replay.add_argument("--positions", type=int, default=200, help="测试的局面数")
+    replay.set_defaults(func=bench_replay)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+book.py: 开局库
+
+开局库是一个二进制文件，由文件头和按 Zobrist key 排序的定长记录组成：
+
+    文件头  magic(8s) version(I) record_size(I) count(Q)
+    记录    key(Q) from(B) to(B) weight(H)
+
+key 是 `Position.zobrist()`，着法是该局面（轮到走棋的一方在下方）里的格子下标，
+同一个局面的多条记录按权重从高到低排列。
+
+文件通过 mmap 只读打开，查询时直接在映射的内存上二分查找，不需要把整个文件读进来；
+多个机器人进程打开同一个文件时共用操作系统的页缓存。
+
+author: wzpan
+email: m@hahack.com
+"""
+import mmap
+import os
+import random
+import struct
+from functools import lru_cache
+from typing import Iterable, List, Optional, Tuple
+
+MAGIC = b"CCBOOK\0\0"
+VERSION = 1
+HEADER = struct.Struct("<8sIIQ")
+RECORD = struct.Struct("<QBBH")
+KEY = struct.Struct("<Q")
+
+# 着法用 (from, to) 表示，与 Position.gen_moves() 一致
+Move = Tuple[int, int]
+
+
+class BookError(Exception):
+    pass
+
+
+class OpeningBook:
+    """
+    只读的开局库
+
+    :param path: 开局库文件路径
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < HEADER.size:
+                raise BookError("{} 不是开局库文件".format(path))
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, record_size, self.count = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC:
+            raise BookError("{} 不是开局库文件".format(path))
+        if version != VERSION or record_size != RECORD.size:
+            raise BookError(
+                "{} 的格式版本是 {}，当前支持的是 {}".format(path, version, VERSION)
+            )
+        if HEADER.size + self.count * RECORD.size > size:
+            raise BookError("{} 不完整".format(path))
+
+    def __len__(self):
+        return self.count
+
+    def _key_at(self, index: int) -> int:
+        return KEY.unpack_from(self.mm, HEADER.size + index * RECORD.size)[0]
+
+    def _lower_bound(self, key: int) -> int:
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key_at(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def lookup(self, key: int) -> List[Tuple[Move, int]]:
+        """
+        查询某个 key 的全部着法
+
+        :param key: 局面的 Zobrist key
+        :return: [(着法, 权重)]，按权重从高到低排列
+        """
+        entries = []
+        index = self._lower_bound(key)
+        while index < self.count:
+            k, i, j, weight = RECORD.unpack_from(
+                self.mm, HEADER.size + index * RECORD.size
+            )
+            if k != key:
+                break
+            entries.append(((i, j), weight))
+            index += 1
+        return entries
+
+    def probe(self, pos) -> List[Tuple[Move, int]]:
+        """
+        查询某个局面的全部着法，过滤掉不合法的着法（例如 key 冲突）
+
+        :param pos: elephantfish.Position 局面
+        :return: [(着法, 权重)]，按权重从高到低排列
+        """
+        entries = self.lookup(pos.zobrist())
+        if not entries:
+            return entries
+        moves = set(pos.gen_moves())
+        return [(move, weight) for move, weight in entries if move in moves]
+
+    def choose(self, pos, rng: Optional[random.Random] = random) -> Optional[Move]:
+        """
+        从开局库中为某个局面选一步棋
+
+        :param pos: elephantfish.Position 局面
+        :param rng: 按权重随机选择时使用的随机数生成器，为 None 时总是选权重最高的着法
+        :return: 着法，开局库里没有这个局面时返回 None
+        """
+        entries = self.probe(pos)
+        if not entries:
+            return None
+        if rng is None:
+            return entries[0][0]
+        moves, weights = zip(*entries)
+        return rng.choices(moves, weights)[0]
+
+    def __iter__(self):
+        """
+        按顺序遍历全部记录 (key, 着法, 权重)
+        """
+        for index in range(self.count):
+            k, i, j, weight = RECORD.unpack_from(
+                self.mm, HEADER.size + index * RECORD.size
+            )
+            yield k, (i, j), weight
+
+    def close(self):
+        self.mm.close()
+
+
+def write_book(path: str, entries: Iterable[Tuple[int, Move, int]]):
+    """
+    写开局库文件。先写临时文件再改名，正在读旧文件的进程不受影响
+
+    :param path: 开局库文件路径
+    :param entries: (key, 着法, 权重) 的序列，同一个 key 的同一个着法只能出现一次
+    """
+    records = sorted(
+        ((key, move, min(weight, 0xFFFF)) for key, move, weight in entries),
+        key=lambda r: (r[0], -r[2], r[1]),
+    )
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, RECORD.size, len(records)))
+        for key, (i, j), weight in records:
+            f.write(RECORD.pack(key, i, j, weight))
+    os.replace(tmp, path)
+
+
+@lru_cache(maxsize=None)
+def open_book(path: str) -> Optional[OpeningBook]:
+    """
+    打开开局库，同一个文件在进程内只映射一次
+
+    :param path: 开局库文件路径
+    :return: 开局库，文件不存在时返回 None
+    """
+    if not path or not os.path.exists(path):
+        return None
+    return OpeningBook(path)
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+book_builder.py: 生成开局库
+
+从局面/着法语料中收集开局局面，用引擎在进程池里逐个验证，写成 book.py 的开局库格式。
+
+语料每行一个 FEN，后面可以跟实际走过的着法（红方在下的坐标）：
+
+    rnbakabnr/9/1c5c1/p1p1p1p1p/9/9/P1P1P1P1P/1C5C1/9/RNBAKABNR w - - 0 1 moves h2e2 h9g7
+
+只有 FEN 的行，例如 data/fen/random_openings.fen ，只收录引擎在该局面给出的着法。
+也可以直接读 gamelog.py 记录的棋谱文件（.pgn、.pgn.gz）或棋谱目录。
+带着法的行会把前 `--max-ply` 步经过的局面都收录进来，实际走过的着法按出现次数加权，
+但只有引擎验证后不比最好的着法差太多（`--margin`）的着法才会进入开局库。
+`--multipv K` 让引擎在每个局面给出最好的 K 个着法，同样只收录分差不超过 margin 的着法。
+
+加上 `--merge` 时会先读入已有的开局库，再把新的着法合并进去，不需要从头生成：
+
+    python book_builder.py -o data/book.bin data/fen/random_openings.fen
+    python book_builder.py -o data/book.bin --merge new_games.txt
+    python book_builder.py -o data/book.bin --merge data/games
+
+author: wzpan
+email: m@hahack.com
+"""
+import argparse
+import os
+import time
+from collections import Counter, defaultdict
+from multiprocessing import Pool
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import elephantfish
+import gamelog
+import tools
+from book import Move, OpeningBook, write_book
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# 引擎自己给出的着法额外加上的权重
+ENGINE_WEIGHT = 1
+
+
+def iter_corpus(
+    paths: Iterable[str], max_ply: int
+) -> Iterator[Tuple[elephantfish.Position, Optional[Move]]]:
+    """
+    逐行读取语料，依次产生 (局面, 在该局面实际走的着法)
+
+    只有 FEN 的行产生 (局面, None)。
+
+    :param paths: 语料文件，或者棋谱文件和目录
+    :param max_ply: 每一行（每一局）最多收录多少步
+    """
+    for path in paths:
+        if gamelog.is_game_file(path):
+            for game in gamelog.iter_games(path):
+                for ply, (pos, move) in enumerate(game.replay()):
+                    if ply >= max_ply:
+                        break
+                    yield pos, move
+            continue
+        with open(path) as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                fen, _, moves = line.partition(" moves ")
+                pos = tools.parseFEN(fen)
+                color = tools.WHITE if fen.split()[1] == "w" else tools.BLACK
+                moves = moves.split()
+                if not moves:
+                    yield pos, None
+                    continue
+                for text in moves[:max_ply]:
+                    move = tools.mparse(color, text)
+                    if move not in pos.gen_moves():
+                        break
+                    yield pos, move
+                    pos, color = pos.move(move), 1 - color
+
+
+def _search(pos: elephantfish.Position, nodes: int) -> Tuple[Move, int]:
+    searcher = elephantfish.Searcher()
+    for _depth, move, score, _pv in searcher.search(pos, (), nodes):
+        pass
+    return move, score
+
+
+def _search_lines(
+    pos: elephantfish.Position, nodes: int, lines: int
+) -> List[Tuple[Move, int, Tuple[Move, ...]]]:
+    searcher = elephantfish.Searcher()
+    found = []
+    for _depth, found in searcher.search_multipv(pos, (), lines, nodes):
+        pass
+    return found
+
+
+def verify(task) -> Tuple[int, List[Tuple[Move, int]]]:
+    """
+    在子进程里验证一个局面的候选着法
+
+    :param task: (key, 局面, {着法: 次数}, 节点数, 允许的分差, 引擎给出的着法数)
+    :return: (key, [(着法, 权重)])
+    """
+    key, pos, candidates, nodes, margin, lines = task
+    found = _search_lines(pos, nodes, lines)
+    if not found:
+        return key, []
+    best_score = found[0][1]
+    engine_moves = {
+        move: ENGINE_WEIGHT
+        for move, score, _pv in found
+        if best_score - score <= margin
+    }
+    entries = []
+    for move, count in candidates.items():
+        if move in engine_moves:
+            continue
+        _, reply_score = _search(pos.move(move), nodes)
+        if best_score + reply_score <= margin:
+            entries.append((move, count))
+    for move, weight in engine_moves.items():
+        entries.append((move, candidates.get(move, 0) + weight))
+    return key, entries
+
+
+def collect(
+    paths: Iterable[str], max_ply: int, min_count: int
+) -> Tuple[Dict[int, elephantfish.Position], Dict[int, Counter]]:
+    """
+    统计语料中的局面和着法
+
+    :return: ({key: 局面}, {key: {着法: 次数}})
+    """
+    positions: Dict[int, elephantfish.Position] = {}
+    played: Dict[int, Counter] = defaultdict(Counter)
+    seen: Counter = Counter()
+    for pos, move in iter_corpus(paths, max_ply):
+        key = pos.zobrist()
+        positions.setdefault(key, pos)
+        seen[key] += 1
+        if move is not None:
+            played[key][move] += 1
+    for key in [key for key, n in seen.items() if n < min_count]:
+        del positions[key]
+        played.pop(key, None)
+    return positions, played
+
+
+def build(args):
+    start = time.time()
+    weights: Dict[Tuple[int, Move], int] = Counter()
+    if args.merge and os.path.exists(args.output):
+        book = OpeningBook(args.output)
+        for key, move, weight in book:
+            weights[key, move] = weight
+        book.close()
+        print("读入已有开局库 {} 条".format(len(weights)))
+
+    positions, played = collect(args.inputs, args.max_ply, args.min_count)
+    print("收集到 {} 个局面".format(len(positions)))
+    tasks = [
+        (key, pos, dict(played.get(key, {})), args.nodes, args.margin, args.multipv)
+        for key, pos in positions.items()
+    ]
+    done = 0
+    with Pool(args.workers) as pool:
+        for key, entries in pool.imap_unordered(verify, tasks, chunksize=4):
+            for move, weight in entries:
+                weights[key, move] += weight
+            done += 1
+            if done % 100 == 0:
+                print("已验证 {}/{}".format(done, len(tasks)), flush=True)
+
+    write_book(args.output, ((key, move, w) for (key, move), w in weights.items()))
+    print(
+        "写入 {} 条记录到 {}，用时 {:.1f} 秒".format(
+            len(weights), args.output, time.time() - start
+        )
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="生成开局库")
+    parser.add_argument(
+        "inputs",
+        nargs="*",
+        default=[os.path.join(HERE, "data", "fen", "random_openings.fen")],
+        help="语料文件",
+    )
+    parser.add_argument(
+        "-o", "--output", default=os.path.join(HERE, "data", "book.bin")
+    )
+    parser.add_argument("--merge", action="store_true", help="合并到已有的开局库")
+    parser.add_argument("--nodes", type=int, default=5000, help="每次验证搜索的节点数")
+    parser.add_argument("--max-ply", type=int, default=20, help="每局最多收录的步数")
+    parser.add_argument(
+        "--min-count", type=int, default=1, help="局面至少出现多少次才收录"
+    )
+    parser.add_argument(
+        "--margin", type=int, default=50, help="着法比最好的着法最多差多少分"
+    )
+    parser.add_argument(
+        "--multipv", type=int, default=1, help="引擎在每个局面给出的着法数"
+    )
+    parser.add_argument("--workers", type=int, default=None, help="进程数")
+    build(parser.parse_args())
+
+
+if __name__ == "__main__":
+    main()
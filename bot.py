@@ -8,23 +8,93 @@ email: m@hahack.com
 """
 from __future__ import annotations
 
+import asyncio
+import atexit
+import os
 import re
+import sys
 
 import qqbot
 
-from chess import ChessGame, get_menu
+import metrics
+from book import open_book
+from chess import (
+    BOOK_FILE,
+    LEVELS,
+    TABLEBASE_DIR,
+    ChessGame,
+    SearchCancelled,
+    get_menu,
+)
+from client import create_client
 from command_register import Bot, CheckFailed
-from utils import give_role, is_admin, send_message
+from elephantfish import CancelToken
+from engine import create_engine
+from gamelog import create_gamelog
+from outbox import create_outbox
+from resultcache import create_result_cache
+from tablebase import open_tablebase
+from utils import get_me, give_role, is_admin
 
 
 class ChineseChessBot(Bot):
     def __init__(self, prefix: str):
         super().__init__(prefix)
+        self.client = create_client(self.token, self.config)
+        self.outbox = create_outbox(self.client, self.config)
+        self.engine = create_engine(self.config)
+        book_path = (self.config.get("book") or {}).get("path", BOOK_FILE)
+        self.book = open_book(os.path.join(os.path.dirname(__file__), book_path))
+        tablebase_path = (self.config.get("tablebase") or {}).get("path", TABLEBASE_DIR)
+        self.tablebase = open_tablebase(
+            os.path.join(os.path.dirname(__file__), tablebase_path)
+        )
+        self.gamelog = create_gamelog(self.config, os.path.dirname(__file__))
+        self.cache = create_result_cache(self.config, os.path.dirname(__file__))
         self.enable_hornor = self.config["hornor_role"]["enable"]
         self.role_info = qqbot.RoleUpdateInfo(
             self.config["hornor_role"]["name"], self.config["hornor_role"]["color"], 1
         )
         self.game_data = {}
+        metrics.gauge(
+            "chess_active_games", "Games in progress", lambda: len(self.game_data)
+        )
+        metrics.gauge(
+            "chess_engine_pending",
+            "Searches queued or running in the engine",
+            lambda: self.engine.pending,
+        )
+        metrics.gauge(
+            "chess_outbox_pending",
+            "Messages waiting in the outbox",
+            lambda: self.outbox.pending,
+        )
+        metrics.gauge(
+            "chess_gamelog_pending",
+            "Games waiting to be written to the game log",
+            lambda: self.gamelog.pending if self.gamelog else 0,
+        )
+        metrics.gauge(
+            "chess_result_cache_entries",
+            "Positions in the shared result cache",
+            lambda: len(self.cache) if self.cache else 0,
+        )
+        metrics.gauge(
+            "chess_table_entries",
+            "Transposition table entries of all games",
+            lambda: sum(len(t) for t in self._tables()),
+        )
+        metrics.gauge(
+            "chess_table_bytes",
+            "Memory used by the transposition table dicts of all games",
+            lambda: sum(sys.getsizeof(t) for t in self._tables()),
+        )
+
+    def _tables(self):
+        for game_data in list(self.game_data.values()):
+            searcher = game_data["game"].searcher
+            yield searcher.tp_score
+            yield searcher.tp_move
 
     async def handle_message(self, event: str, message: qqbot.Message):
         message.content = re.sub(r"<@\![0-9]+>", "", message.content).strip()
@@ -35,11 +105,13 @@ class ChineseChessBot(Bot):
         if _validate_func(params):
             await do_move(params, event, message)
             return
-        await send_message(self.token, "抱歉，没明白你的意思呢。" + get_menu(), event, message)
+        self.outbox.send("抱歉，没明白你的意思呢。" + get_menu(), event, message)
 
 
 bot = ChineseChessBot(prefix="/")
 
+THINKING = "我还在思考上一步呢，请稍等~"
+
 
 def _get_game_by_channel_id(channel_id: str):
     """
@@ -59,25 +131,48 @@ async def _invalid_func(
     当参数不符合要求时的处理函数
     """
     if isinstance(error, CheckFailed):
-        await send_message(bot.token, "请输入正确的步法。例如 /下棋 h2e2", event, message)
+        bot.outbox.send("请输入正确的步法。例如 /下棋 h2e2", event, message)
 
 
-def _is_surrenderable(guild_id: str, channel_id: str, user_id: str):
+async def _is_surrenderable(guild_id: str, channel_id: str, user_id: str):
     """
     是否可以结束游戏
     只有开局的人和管理员才能结束游戏
     """
     game = _get_game_by_channel_id(channel_id)
-    return is_admin(bot.token, guild_id, user_id) or (
-        game and game["creator"] == user_id
-    )
+    if game and game["creator"] == user_id:
+        return True
+    return await is_admin(bot.client, guild_id, user_id)
 
 
-def _give_hornor(guild_id: str, user_id: str):
-    api = qqbot.UserAPI(bot.token, False)
-    if bot.enable_hornor and is_admin(bot.token, guild_id, api.me().id):
+def _log_game(game_data: dict, result: str = None):
+    """
+    把结束的对局写进棋谱记录
+
+    :param result: 对局结果，默认用 ChessGame 记下的结果
+    """
+    if bot.gamelog is None:
+        return
+    game = game_data["game"]
+    if result is not None:
+        game.result = result
+    bot.gamelog.write(game.record(Red=game_data["creator"]))
+
+
+def _cancel_search(game_data: dict):
+    """
+    取消这一局正在进行的电脑思考，CPU 马上让给别的子频道
+    """
+    token = game_data.get("search")
+    if token is not None:
+        token.cancel()
+
+
+async def _give_hornor(guild_id: str, user_id: str):
+    me = await get_me(bot.client)
+    if bot.enable_hornor and await is_admin(bot.client, guild_id, me.id):
         qqbot.logger.info("颁发象棋大师身份组")
-        give_role(bot.token, guild_id, user_id, bot.role_info)
+        await give_role(bot.client, guild_id, user_id, bot.role_info)
     else:
         qqbot.logger.info("不颁发象棋大师身份组")
 
@@ -87,11 +182,22 @@ async def start_game(params: str, event: str, message: qqbot.Message):
     qqbot.logger.info("开局")
     if message.channel_id in bot.game_data:
         ret = "游戏已经开始了，请等待下一局。您也可以使用 `/投降` 指令提前结束游戏。"
+    elif params and params not in LEVELS:
+        ret = "没有这个难度哦，可选的难度有：{}".format("、".join(LEVELS))
     else:
-        game = ChessGame()
-        bot.game_data[message.channel_id] = {"creator": message.author.id, "game": game}
+        game = ChessGame(
+            level=LEVELS.get(params),
+            book=bot.book,
+            tablebase=bot.tablebase,
+            cache=bot.cache,
+        )
+        bot.game_data[message.channel_id] = {
+            "creator": message.author.id,
+            "game": game,
+            "lock": asyncio.Lock(),  # 电脑思考期间不允许再改动棋局
+        }
         ret = game.get_computer_board()
-    await send_message(bot.token, ret, event, message)
+    bot.outbox.send(ret, event, message)
     return True
 
 
@@ -99,7 +205,7 @@ async def start_game(params: str, event: str, message: qqbot.Message):
 async def ask_menu(params: str, event: str, message: qqbot.Message):
     qqbot.logger.info("菜单")
     ret = get_menu()
-    await send_message(bot.token, ret, event, message)
+    bot.outbox.send(ret, event, message)
     return True
 
 
@@ -108,34 +214,56 @@ async def surrender(params: str, event: str, message: qqbot.Message):
     qqbot.logger.info("投降")
     game_data = _get_game_by_channel_id(message.channel_id)
     if game_data:
-        if _is_surrenderable(message.guild_id, message.channel_id, message.author.id):
+        if await _is_surrenderable(
+            message.guild_id, message.channel_id, message.author.id
+        ):
             bot.game_data.pop(message.channel_id)
+            _cancel_search(game_data)
+            # 等电脑停下再记棋谱，否则可能记到一半的着法
+            async with game_data["lock"]:
+                _log_game(game_data, "0-1")
             ret = "游戏结束，您输了。"
         else:
             ret = "只有开局的人或者管理员才可以结束游戏哦"
     else:
         ret = "游戏还没开始。您可以使用 `/开局` 指令开始游戏。"
-    await send_message(bot.token, ret, event, message)
+    bot.outbox.send(ret, event, message)
     return True
 
 
 async def do_move(params: str, event: str, message: qqbot.Message):
     game_data = _get_game_by_channel_id(message.channel_id)
     if game_data:
-        game = game_data["game"]
-        res, ret = game.move(params)
-        await send_message(bot.token, ret, event, message)
-        if res:
-            is_end, ret = game.response()
-            if is_end:
-                bot.game_data.pop(message.channel_id)
-                if "您赢了" in ret and event != "DIRECT_MESSAGE_CREATE":
-                    _give_hornor(message.guild_id, message.author.id)
-                    ret += "\n\n👑恭喜获得新身份组【{}】".format(bot.role_info.name)
-            await send_message(bot.token, ret, event, message)
+        if game_data["lock"].locked():
+            bot.outbox.send(THINKING, event, message)
+            return
+        async with game_data["lock"]:
+            game = game_data["game"]
+            res, ret = game.move(params)
+            bot.outbox.send(ret, event, message)
+            if res:
+                game_data["search"] = CancelToken()
+                try:
+                    is_end, ret = await bot.engine.respond(game, game_data["search"])
+                except SearchCancelled:
+                    # 投降或悔棋取消了思考，由它们回复
+                    return
+                finally:
+                    del game_data["search"]
+                if _get_game_by_channel_id(message.channel_id) is not game_data:
+                    # 思考期间游戏已经被结束了
+                    return
+                if is_end:
+                    _log_game(bot.game_data.pop(message.channel_id))
+                    if "您赢了" in ret and event != "DIRECT_MESSAGE_CREATE":
+                        await _give_hornor(message.guild_id, message.author.id)
+                        ret += "\n\n👑恭喜获得新身份组【{}】".format(
+                            bot.role_info.name
+                        )
+                bot.outbox.send(ret, event, message)
     else:
         ret = "游戏还没开始。您可以使用 `/开局` 指令开始游戏。"
-        await send_message(bot.token, ret, event, message)
+        bot.outbox.send(ret, event, message)
 
 
 @bot.command("下棋", checks=_validate_func, on_error=_invalid_func)
@@ -148,21 +276,51 @@ async def move(params: str, event: str, message: qqbot.Message):
 @bot.command("悔棋")
 async def cancel(params: str, event: str, message: qqbot.Message):
     qqbot.logger.info("悔棋")
+    params = params.strip()
+    if params and not (params.isdigit() and int(params) > 0):
+        bot.outbox.send("请使用 `/悔棋 步数` 指令，步数是正整数", event, message)
+        return True
+    rounds = int(params) if params else 1
     game_data = _get_game_by_channel_id(message.channel_id)
     if game_data:
-        game = game_data["game"]
-        ret = game.cancel()
-        await send_message(bot.token, ret, event, message)
+        if "search" in game_data:
+            # 电脑正在思考：取消思考，等它停下再悔棋
+            _cancel_search(game_data)
+            async with game_data["lock"]:
+                if _get_game_by_channel_id(message.channel_id) is not game_data:
+                    return True
+                ret = game_data["game"].cancel(rounds)
+        elif game_data["lock"].locked():
+            ret = THINKING
+        else:
+            ret = game_data["game"].cancel(rounds)
+        bot.outbox.send(ret, event, message)
     else:
         ret = "游戏还没开始。您可以使用 `/开局` 指令开始游戏。"
-        await send_message(bot.token, ret, event, message)
+        bot.outbox.send(ret, event, message)
     return True
 
 
+def _close_client():
+    """
+    关闭连接池。qqbot 在 Ctrl+C 后退出事件循环但不关闭它，这里在同一个循环里收尾
+    """
+    loop = asyncio.get_event_loop()
+    if not loop.is_closed() and not loop.is_running():
+        loop.run_until_complete(bot.client.close())
+
+
 def run():
     """
     启动机器人
     """
+    metrics.start(bot.config)
+    if bot.cache is not None:
+        bot.cache.autosave()
+    if bot.gamelog is not None:
+        # 退出时写完队列里的对局，最后一个文件才有完整的 gzip 结尾
+        atexit.register(bot.gamelog.close)
+    atexit.register(_close_client)
     # @机器人后推送被动消息
     qqbot_handler = qqbot.Handler(
         qqbot.HandlerType.AT_MESSAGE_EVENT_HANDLER, bot.handle_message
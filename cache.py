@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+cache.py: 带过期时间的异步缓存
+
+author: wzpan
+email: m@hahack.com
+"""
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Dict, Hashable, Tuple
+
+
+class TTLCache:
+    """
+    带过期时间的异步缓存
+
+    - 查询结果为 None 时按 `negative_ttl` 缓存（负缓存），避免反复查询不存在的数据
+    - 同一个 key 的并发查询只会真正请求一次
+    - 超过 `max_size` 时淘汰最早写入的条目
+    """
+
+    def __init__(self, ttl: float, negative_ttl: float = None, max_size: int = 10000):
+        self.ttl = ttl
+        self.negative_ttl = ttl if negative_ttl is None else negative_ttl
+        self.max_size = max_size
+        self._data: Dict[Hashable, Tuple[float, Any]] = {}
+        self._pending: Dict[Hashable, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def get_cached(self, key: Hashable, default: Any = None) -> Any:
+        """
+        只查缓存，不发请求
+
+        :param key: 缓存的 key
+        :param default: 没有缓存或者已经过期时的返回值
+        """
+        item = self._data.get(key)
+        if item is None or item[0] < time.monotonic():
+            return default
+        return item[1]
+
+    def put(self, key: Hashable, value: Any):
+        """
+        写入缓存
+        """
+        ttl = self.ttl if value is not None else self.negative_ttl
+        if key not in self._data and len(self._data) >= self.max_size:
+            self._data.pop(next(iter(self._data)))
+        self._data[key] = (time.monotonic() + ttl, value)
+
+    def invalidate(self, key: Hashable):
+        """
+        让某个 key 的缓存失效
+        """
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    async def get(self, key: Hashable, loader: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        读取缓存，没有命中时调用 loader 加载
+
+        :param key: 缓存的 key
+        :param loader: 加载数据的协程函数，加载失败时抛出的异常不会被缓存
+        :return: 缓存或者加载到的值
+        """
+        item = self._data.get(key)
+        if item is not None and item[0] >= time.monotonic():
+            self.hits += 1
+            return item[1]
+        self.misses += 1
+        pending = self._pending.get(key)
+        if pending is not None:
+            return await asyncio.shield(pending)
+        future = asyncio.get_running_loop().create_future()
+        self._pending[key] = future
+        try:
+            value = await loader()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # 没有人等待时也要取走异常，避免 "exception was never retrieved"
+            future.exception()
+            raise
+        else:
+            self.put(key, value)
+            future.set_result(value)
+            return value
+        finally:
+            self._pending.pop(key, None)
@@ -1,20 +1,72 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import hashlib
+import os
 import random
+import re
+import time
+from array import array
+from collections import namedtuple
 
+import metrics
+import tools
 from elephantfish import *
+from gamelog import Game
+from resultcache import EXACT, LOWER
+
+# 默认的开局库文件
+BOOK_FILE = os.path.join(os.path.dirname(__file__), "data", "book.bin")
+# 默认的残局库目录
+TABLEBASE_DIR = os.path.join(os.path.dirname(__file__), "data", "tablebase")
+
+book_hits = metrics.counter("chess_book_hits_total", "Moves played from the book")
+searches_cancelled = metrics.counter(
+    "chess_searches_cancelled_total", "Searches cancelled by /投降 or /悔棋"
+)
+
+# 难度等级：每一步固定的搜索节点数和最大深度，与机器快慢和负载无关
+Level = namedtuple("Level", "name nodes depth")
+LEVELS = {
+    level.name: level
+    for level in (
+        Level("入门", 500, 2),
+        Level("简单", 3000, 4),
+        Level("普通", 20000, 6),
+        Level("困难", 50000, 8),
+        Level("大师", 120000, None),
+    )
+}
+
+# 按思考时间下棋时，共享结果缓存里的结果至少要这么深才直接使用
+CACHE_DEPTH = 6
+
+# 难度等级的对局在共享结果缓存里用局面的 key 异或等级的 key，
+# 只会走到同一等级搜出来的着法，不会因为缓存而变强
+LEVEL_KEYS = {
+    name: int.from_bytes(hashlib.sha1(name.encode()).digest()[:8], "little")
+    for name in LEVELS
+}
+
+
+class SearchCancelled(Exception):
+    """
+    电脑思考期间玩家投降或悔棋，这一步不再走
+    """
 
 
 def get_menu():
     return """功能菜单：
-/开局
+/开局 [难度]
     开一局游戏
+    难度可选：入门、简单、普通、困难、大师
+    示例： /开局 困难
 /下棋 行1列1行2列2
     根据步法下棋
     示例： /下棋 h2e2
-/悔棋
-    悔一步棋
+/悔棋 [步数]
+    悔棋，默认悔一步
+    示例： /悔棋 3
 /投降
     投降认输。只有开局的人才能投降
 """
@@ -41,9 +93,89 @@ class ChessGame:
     """
     对 bupticybee/elephantfish 的封装    
     """
-    def __init__(self):
-        self.hist = [Position(initial, 0)]  # 历史记录
-        self.searcher = Searcher()  # 解法查找器
+    def __init__(
+        self,
+        min_think=None,
+        max_think=None,
+        level=None,
+        book=None,
+        tablebase=None,
+        cache=None,
+    ):
+        # 历史记录只保存着法和每个局面的 Zobrist key，完整的局面只保留最后一次
+        # 不可逆着法（吃子、兵卒前进）以后的，之前的局面不可能再出现
+        self.start = Position(initial, 0)  # 开局局面
+        self.move_codes = array("H")  # 全部着法，from * 256 + to，红方在下的格子
+        self.keys = array("Q")  # 每个局面的 Zobrist key，从轮到走棋的一方看
+        self.key_counts = {}  # 最后一次不可逆着法以后各局面出现的次数
+        self.hist = []  # 最后一次不可逆着法以后的局面，最后一个是当前局面
+        self._replay(0)
+        self.searcher = Searcher(tablebase)  # 解法查找器，tablebase 为残局库
+        self.level = level  # 难度等级，None 表示按思考时间下棋
+        self.book = book  # 开局库，None 表示不使用
+        self.cache = cache  # 跨对局共享的结果缓存，None 表示不使用
+        self.last_depth = 0  # 上一步搜索到的深度
+        self.min_think = min_think  # 本局每步的最短思考时间，None 表示不限制
+        self.max_think = max_think  # 本局每步的最长思考时间，None 表示不限制
+        self.result = None  # 对局结果，"1-0" 表示玩家（红方）赢，"0-1" 表示电脑赢
+        self.started = time.time()
+
+    @property
+    def moves(self):
+        """
+        全部着法，h2e2 的形式，红方在下的坐标，用于记录棋谱
+        """
+        return [self.render(c >> 8) + self.render(c & 0xFF) for c in self.move_codes]
+
+    def _push(self, move):
+        """
+        走一步，move 是当前局面（轮到走棋的一方在下）里的着法
+        """
+        pos = self.hist[-1]
+        i, j = move
+        # 玩家执红先走，电脑的着法要翻转成红方在下的格子
+        if len(self.move_codes) % 2 == 0:
+            self.move_codes.append(i << 8 | j)
+        else:
+            self.move_codes.append((254 - i) << 8 | (254 - j))
+        irreversible = pos.board[j] != "." or (pos.board[i] == "P" and j == i + N)
+        pos = pos.move(move)
+        if irreversible:
+            self.hist = [pos]
+            self.key_counts = {}
+        else:
+            self.hist.append(pos)
+        key = pos.zobrist()
+        self.keys.append(key)
+        self.key_counts[key] = self.key_counts.get(key, 0) + 1
+
+    def _replay(self, plies):
+        """
+        从开局重新走前 plies 步，用于悔棋
+        """
+        codes = self.move_codes[:plies]
+        self.move_codes = array("H")
+        self.keys = array("Q", [self.start.zobrist()])
+        self.key_counts = {self.keys[0]: 1}
+        self.hist = [self.start]
+        for ply, code in enumerate(codes):
+            i, j = code >> 8, code & 0xFF
+            self._push((i, j) if ply % 2 == 0 else (254 - i, 254 - j))
+
+    def setup(self, pos):
+        """
+        从指定的局面开始对局，例如压测时使用的随机开局
+
+        :param pos: 红方在下、轮到红方走的局面
+        """
+        self.start = pos
+        self._replay(0)
+
+    def repetitions(self):
+        """
+        当前局面在本局中出现的次数
+        """
+        return self.key_counts[self.keys[-1]]
 
     def parse(self, c):
         fil, rank = ord(c[0]) - ord("a"), int(c[1])
@@ -103,69 +235,202 @@ class ChessGame:
         move = self.parse(match.group(1)), self.parse(match.group(2))
 
         if move in self.hist[-1].gen_moves():
-            self.hist.append(self.hist[-1].move(move))
+            self._push(move)
             return True, self.get_player_board()
         else:
             return False, "走法不合法，请使用 `/下棋` 指令重试"
 
-    def cancel(self):
+    def cancel(self, rounds=1):
         """
         玩家悔棋
+
+        玩家和电脑各一着算一步。电脑的思考被取消时还没有应着，
+        玩家刚走的那一着算作第一步。
+
+        :param rounds: 悔几步
         """
-        if len(self.hist) > 2:
-            self.hist.pop()
-            self.hist.pop()
-            return "好吧，让你悔一步棋\n\n" + self.get_computer_board()
-        else:
+        plies = len(self.move_codes)
+        # 玩家执红先走，着法数是奇数时电脑还没有应着
+        undo = 2 * rounds - plies % 2
+        if plies < 2 - plies % 2:
             return "当前已经没有可以悔棋的步骤啦"
+        if undo > plies:
+            return "最多只能悔 {} 步棋".format((plies + 1) // 2)
+        self._replay(plies - undo)
+        if rounds == 1:
+            return "好吧，让你悔一步棋\n\n" + self.get_computer_board()
+        return "好吧，让你悔 {} 步棋\n\n".format(rounds) + self.get_computer_board()
 
-    def response(self):
+    def response(self, think_time=None, clock=time.time):
         """
         电脑下棋及结果判断
         
+        :param think_time: 思考时间（秒），默认为 `THINK_TIME`
+        :param clock: 计时函数，见 `think`
         :return: 是否结束游戏, 提示信息
+        :raises SearchCancelled: `searcher.cancel_token` 被取消
         """
+        self.check_cancelled()
         if self.hist[-1].score <= -MATE_LOWER:
             self.hist.clear()
+            self.result = "1-0"
             return True, "\n恭喜，您赢了！\n"
+        if self.repetitions() >= 3:
+            self.result = "1/2-1/2"
+            return True, "\n同一局面出现了三次，和棋。\n"
 
-        _, move, score = self.think()
+        move = self.book_move()
+        if move is None:
+            _, move, score = self.think(think_time, clock)
+        else:
+            score = self.hist[-1].score
 
         ret = ""
 
         if score == MATE_UPPER:
             ret += "将军！\n"
 
-        ret += get_ack() + "\n我的下一着：{}\n".format(
-            self.render(255 - move[0] - 1) + self.render(255 - move[1] - 1)
-        )
+        move_str = self.render(255 - move[0] - 1) + self.render(255 - move[1] - 1)
+        ret += get_ack() + "\n我的下一着：{}\n".format(move_str)
 
-        self.hist.append(self.hist[-1].move(move))
+        self._push(move)
 
         ret += self.get_computer_board()
 
-        if len(self.hist) > 4:
-            self.hist.pop(0)
-            self.hist.pop(0)
-
         if self.hist[-1].score <= -MATE_LOWER:
             self.hist.clear()
+            self.result = "0-1"
             return True, ret + "\n\n游戏结束，您输了。"
+        if self.repetitions() >= 3:
+            self.result = "1/2-1/2"
+            return True, ret + "\n\n同一局面出现了三次，和棋。"
 
         return False, ret
 
-    def think(self):
+    def record(self, **headers) -> Game:
+        """
+        本局的棋谱。用 `setup` 换过开局局面时带上 FEN 标签
+
+        :param headers: 其它 PGN 标签，例如 Red（玩家）
+        :return: gamelog.Game，没有结束的对局结果为 "*"
+        """
+        headers = {
+            "Date": time.strftime("%Y.%m.%d", time.localtime(self.started)),
+            "Black": "elephantfish",
+            **headers,
+        }
+        if self.level is not None:
+            headers["Level"] = self.level.name
+        if self.start.board != initial:
+            # 用 `setup` 换过开局局面的对局，回放时要从这个局面开始
+            headers["FEN"] = tools.renderFEN(self.start)
+        return Game(list(self.moves), self.result or "*", headers)
+
+    def check_cancelled(self):
+        """
+        思考被取消时抛出 SearchCancelled
+        """
+        token = self.searcher.cancel_token
+        if token is not None and token.cancelled:
+            searches_cancelled.inc()
+            raise SearchCancelled()
+
+    def book_move(self):
+        """
+        从开局库里找下一步
+
+        设置了难度等级时总是选权重最高的着法，保证同一局面的结果不变。
+
+        :return: 着法，开局库里没有当前局面时返回 None
+        """
+        if self.book is None:
+            return None
+        move = self.book.choose(self.hist[-1], None if self.level else random)
+        if move is not None:
+            book_hits.inc()
+        return move
+
+    def think(self, think_time=None, clock=time.time):
         """
         电脑思考
         
-        在限定时间内完成下一步的思考，并返回走法。
-        可以通过调整 `TIME_LIMIT` 来设置电脑的最长思考时间。
+        在限定时间内完成下一步的思考，并返回走法。时间到了的时候正在搜的那一层
+        中途停下，走已经搜完的最深一层的着法，不会超时。
+        可以通过调整 `THINK_TIME` 来设置电脑的默认思考时间，
+        机器人运行时由 `engine.TimeManager` 根据负载给出每一步的思考时间。
         值越长，电脑越强，但响应时间也会越久。
+
+        设置了难度等级时按等级的节点数和深度搜索，忽略思考时间，
+        同一局面的计算量是固定的。
+
+        有共享结果缓存时先查缓存，结果够深（见 `cache_depth`）就直接走缓存的着法；
+        不够深时用缓存的着法引导搜索，搜索完把结果写回缓存。难度等级的对局只用
+        同一等级的结果（见 `LEVEL_KEYS`），也不用它们引导搜索，每一步的计算量不变。
+        搜索中有局面因为本局走过而被判和时，结果和本局的历史有关，
+        写回时标成下界，只用来引导其它对局的搜索。
+
+        :param think_time: 思考时间（秒），默认为 `THINK_TIME`
+        :param clock: 计时函数。分时搜索时只计本局占用 CPU 的时间，见 `engine.Task.clock`
+        :raises SearchCancelled: 思考被取消，可能连第一层都没有算完
+        """
+        if self.cache is None:
+            return self._search(think_time, clock)
+        pos = self.hist[-1]
+        key = pos.zobrist()
+        if self.level is not None:
+            key ^= LEVEL_KEYS[self.level.name]
+        legal = set(pos.gen_moves())
+        entry, usable = self.cache.probe(
+            key,
+            self.cache_depth(),
+            # 不直接使用造成重复局面的着法，缓存的结果没有考虑本局的历史
+            avoid=lambda move: move not in legal
+            or pos.move(move).zobrist() in self.key_counts,
+        )
+        if usable:
+            self.last_depth = entry.depth
+            return entry.depth, entry.move, entry.score
+        if self.level is None and entry is not None and entry.move in legal:
+            self.searcher.tp_move[pos] = entry.move
+        depth, move, score = self._search(think_time, clock)
+        if move is not None:
+            bound = EXACT if self.searcher.rep_hits == 0 else LOWER
+            self.cache.put(key, move, score, depth, bound)
+        return depth, move, score
+
+    def cache_depth(self):
         """
-        start = time.time()
-        for _depth, move, score in self.searcher.search(self.hist[-1], self.hist):
-            if time.time() - start > THINK_TIME:
-                break
+        共享结果缓存里的结果至少要多深才直接使用
+
+        难度等级的对局只查得到同一等级的结果，都可以使用；
+        其它的取本局上一步搜索到的深度和 `CACHE_DEPTH` 中较大的一个
+        """
+        if self.level is not None:
+            return 0
+        return max(self.last_depth, CACHE_DEPTH)
+
+    def _search(self, think_time, clock):
+        if self.level is not None:
+            start = clock()
+            for _depth, move, score, _pv in self.searcher.search(
+                self.hist[-1], self.hist, self.level.nodes, self.level.depth
+            ):
+                pass
+            self.check_cancelled()
+            metrics.observe_search(self.searcher, _depth, clock() - start)
+            self.last_depth = _depth
+            return _depth, move, score
+        if think_time is None:
+            think_time = THINK_TIME
+        start = clock()
+        # 到了思考时间，搜到一半的这一层也马上停下，走上一层的结果
+        for _depth, move, score, _pv in self.searcher.search(
+            self.hist[-1], self.hist, deadline=start + think_time, clock=clock
+        ):
+            pass
+        self.check_cancelled()
+        metrics.observe_search(self.searcher, _depth, clock() - start)
+        self.last_depth = _depth
         return _depth, move, score
 
 
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+client.py: 机器人共用的 API 客户端
+
+qqbot 自带的 AsyncHttp 每发一个请求都会新建并关闭一个 aiohttp.ClientSession，
+每次都要重新握手。这里让同一个机器人的所有 API 对象共用一个长连接的 session。
+
+author: wzpan
+email: m@hahack.com
+"""
+from typing import Any, Dict, Optional
+
+import aiohttp
+import qqbot
+from qqbot import Token
+from qqbot.core.network.async_http import AsyncHttp, _handle_response
+
+from cache import TTLCache
+
+USER_AGENT = "BotPythonSDK/v0.5.4"
+
+
+class PooledHttp(AsyncHttp):
+    """
+    复用同一个 aiohttp.ClientSession 的 AsyncHttp
+    """
+
+    def __init__(
+        self,
+        token: Token,
+        timeout: float = 3,
+        limit: int = 100,
+        limit_per_host: int = 20,
+        keepalive_timeout: float = 30,
+    ):
+        super().__init__(timeout, token.get_string(), token.get_type())
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.headers = {
+            "Authorization": self.scheme + " " + self.token,
+            "User-Agent": USER_AGENT,
+        }
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        # session 必须在事件循环里创建，所以等到第一次请求时才建立
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                keepalive_timeout=self.keepalive_timeout,
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                headers=self.headers,
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+            )
+        return self._session
+
+    async def _request(self, method: str, api_url, request=None, params=None):
+        async with self.session.request(
+            method, url=api_url, params=params, json=request
+        ) as resp:
+            content = await resp.text()
+            _handle_response(api_url, resp, content)
+            return content
+
+    async def get(self, api_url, request=None, params=None):
+        return await self._request("GET", api_url, request, params)
+
+    async def post(self, api_url, request=None, params=None):
+        return await self._request("POST", api_url, request, params)
+
+    async def delete(self, api_url, request=None, params=None):
+        return await self._request("DELETE", api_url, request, params)
+
+    async def put(self, api_url, request=None, params=None):
+        return await self._request("PUT", api_url, request, params)
+
+    async def patch(self, api_url, request=None, params=None):
+        return await self._request("PATCH", api_url, request, params)
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+
+class BotClient:
+    """
+    一个机器人共用的 API 对象集合
+
+    所有 API 共用同一个 PooledHttp。成员和身份组的查询结果缓存在
+    `member_cache` 和 `role_cache` 里，key 分别是 (频道ID, 用户ID) 和 (频道ID, 身份组名)。
+    """
+
+    def __init__(
+        self,
+        token: Token,
+        is_sandbox: bool = False,
+        cache_options: Dict[str, Any] = None,
+        **http_options: Any,
+    ):
+        self.token = token
+        self.is_sandbox = is_sandbox
+        self.http = PooledHttp(token, **http_options)
+        self.message_api = self._bind(qqbot.AsyncMessageAPI)
+        self.dms_api = self._bind(qqbot.AsyncDmsAPI)
+        self.member_api = self._bind(qqbot.AsyncGuildMemberAPI)
+        self.role_api = self._bind(qqbot.AsyncGuildRoleAPI)
+        self.user_api = self._bind(qqbot.AsyncUserAPI)
+
+        cache_options = cache_options or {}
+        negative_ttl = cache_options.get("negative_ttl", 30)
+        max_size = cache_options.get("max_size", 10000)
+        self.member_cache = TTLCache(
+            cache_options.get("member_ttl", 60), negative_ttl, max_size
+        )
+        self.role_cache = TTLCache(
+            cache_options.get("role_ttl", 300), negative_ttl, max_size
+        )
+        self.me_cache = TTLCache(cache_options.get("me_ttl", 3600), negative_ttl, 1)
+
+    def _bind(self, api_class):
+        api = api_class(self.token, self.is_sandbox)
+        api.http_async = self.http
+        return api
+
+    async def close(self):
+        await self.http.close()
+
+
+def create_client(token: Token, config: Dict[str, Any]) -> BotClient:
+    """
+    根据配置文件中的 `http` 和 `cache` 两节创建客户端
+
+    :param token: 机器人 Token 对象
+    :param config: 配置文件内容
+    """
+    options = dict(config.get("http") or {})
+    is_sandbox = options.pop("sandbox", False)
+    return BotClient(token, is_sandbox, config.get("cache"), **options)
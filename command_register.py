@@ -8,12 +8,24 @@ email: m@hahack.com
 """
 import asyncio
 import os
+import time
 from dataclasses import dataclass
 from typing import Callable, Coroutine, TypeVar, Any, Dict
 
 import qqbot
 from qqbot.core.util.yaml_util import YamlUtil
 
+import metrics
+
+# 可以通过环境变量 CHESS_BOT_CONFIG 指定其他配置文件
+CONFIG_PATH = os.environ.get(
+    "CHESS_BOT_CONFIG", os.path.join(os.path.dirname(__file__), "config.yml")
+)
+
+dispatch_seconds = metrics.histogram(
+    "chess_command_seconds", "Time spent handling a command"
+)
+
 T = TypeVar("T")
 Coro = Coroutine[Any, Any, T]
 
@@ -40,7 +52,7 @@ class Bot:
 
     @property
     def config(self) -> Dict[str, Any]:
-        return YamlUtil.read(os.path.join(os.path.dirname(__file__), "config.yml"))
+        return YamlUtil.read(CONFIG_PATH)
 
     def command(
         self,
@@ -81,11 +93,14 @@ class Bot:
                 return False
         param = split[1] if len(split) > 1 else ""
         qqbot.logger.info("command %s, param %s" % (invoked_command.name, param))
+        start = time.monotonic()
         try:
             await invoked_command.callback(param, event, message)
         except Exception as e:
             if invoked_command.on_error:
                 await invoked_command.on_error(e, param, event, message)
+        finally:
+            dispatch_seconds.observe(time.monotonic() - start)
         return True
 
     async def handle_message(self, event: str, message: qqbot.Message):
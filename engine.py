@@ -0,0 +1,358 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+engine.py: 象棋引擎的计算队列
+
+搜索是纯 CPU 计算，直接在事件循环里跑会卡住所有子频道的消息处理。
+这里把搜索放到专门的线程里排队执行，并记录排队时间。
+
+默认一次只算一个搜索，排在后面的子频道要等前面的搜索全部算完。
+分时模式（`sliced`）下每个搜索都有自己的线程，但同一时刻只有 `Scheduler`
+选中的那个在算：搜索每隔 `elephantfish.CHECK_NODES` 个节点停下来问一次调度器，
+用完一个时间片就把 CPU 让给别的搜索，下次轮到时从停下的地方接着算。
+调度器优先照顾快要超过截止时间的搜索，其余的按占用 CPU 的时间公平分配。
+
+author: wzpan
+email: m@hahack.com
+"""
+import asyncio
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Deque, Dict, List, Optional
+
+import metrics
+from chess import SearchCancelled, searches_cancelled
+from elephantfish import CancelToken
+
+engine_wait = metrics.histogram(
+    "chess_engine_wait_seconds", "Time a search waited in the engine queue"
+)
+engine_run = metrics.histogram(
+    "chess_engine_run_seconds", "Time a job spent running in the engine"
+)
+think_budget = metrics.histogram(
+    "chess_think_budget_seconds", "Think time given to each search"
+)
+engine_switches = metrics.counter(
+    "chess_engine_switches_total", "Times the scheduler switched between searches"
+)
+
+
+class Engine:
+    """
+    引擎计算队列
+
+    :param workers: 计算线程数。受 GIL 限制，多个线程并不能并行搜索，默认只用一个
+    :param window: 保留最近多少次排队时间用于统计
+    :param sliced: 分时模式，最多同时进行 workers 个搜索，由调度器轮流分配 CPU
+    :param quantum: 分时模式下的时间片（秒）
+    """
+
+    def __init__(
+        self,
+        workers: int = 1,
+        window: int = 1000,
+        sliced: bool = False,
+        quantum: float = 0.05,
+    ):
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix="engine")
+        self.scheduler = Scheduler(quantum) if sliced else None
+        self.pending = 0  # 排队和正在计算的任务数
+        self.completed = 0
+        self.waits: Deque[float] = deque(maxlen=window)  # 最近的排队时间
+        self.runs: Deque[float] = deque(maxlen=window)  # 最近的计算时间
+        self.latencies: Deque[float] = deque(maxlen=window)  # 最近的排队加计算时间
+        self.timeman = TimeManager(self)
+
+    async def run(
+        self,
+        func: Callable[..., Any],
+        *args: Any,
+        cancel_token: Optional[CancelToken] = None,
+    ) -> Any:
+        """
+        把一次计算放进队列，等待它完成
+
+        :param func: 要执行的函数，例如 `ChessGame.response`
+        :param cancel_token: 还在排队时被取消的计算直接出队，不用等排到它
+        :return: func 的返回值
+        :raises chess.SearchCancelled: 排队时被取消
+        """
+        queued = time.monotonic()
+
+        def job():
+            started = time.monotonic()
+            wait = started - queued
+            self.waits.append(wait)
+            engine_wait.observe(wait)
+            try:
+                return func(*args)
+            finally:
+                finished = time.monotonic()
+                self.runs.append(finished - started)
+                self.latencies.append(finished - queued)
+                engine_run.observe(finished - started)
+
+        self.pending += 1
+        future = self.executor.submit(job)
+        if cancel_token is not None:
+            # 已经开始的计算取消不了，由搜索自己检查 cancel_token 停下
+            cancel_token.on_cancel(future.cancel)
+        try:
+            return await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            if not (future.cancelled() and cancel_token and cancel_token.cancelled):
+                raise
+            searches_cancelled.inc()
+            raise SearchCancelled()
+        finally:
+            self.pending -= 1
+            self.completed += 1
+
+    async def respond(self, game, cancel_token: Optional[CancelToken] = None):
+        """
+        让电脑走一步，思考时间在真正开始计算时由 `timeman` 决定
+
+        分时模式下思考时间只计本局占用 CPU 的时间，截止时间是排队时刻加上 `timeman.slo`。
+
+        :param game: ChessGame 对象
+        :param cancel_token: 取消后搜索很快停下，还在排队的马上出队
+        :return: ChessGame.response 的返回值
+        :raises chess.SearchCancelled: 思考被取消
+        """
+        if self.scheduler is None:
+            return await self.run(
+                self._response, game, cancel_token, cancel_token=cancel_token
+            )
+        deadline = time.monotonic() + self.timeman.slo
+        return await self.run(
+            self._sliced_response,
+            game,
+            cancel_token,
+            deadline,
+            cancel_token=cancel_token,
+        )
+
+    def _response(self, game, cancel_token: Optional[CancelToken]):
+        game.searcher.cancel_token = cancel_token
+        try:
+            return game.response(self.timeman.budget(game))
+        finally:
+            game.searcher.cancel_token = None
+
+    def _sliced_response(
+        self, game, cancel_token: Optional[CancelToken], deadline: float
+    ):
+        budget = self.timeman.budget(game)
+        task = Task(deadline, self.timeman.max_think if budget is None else budget)
+        self.scheduler.acquire(task)
+        game.searcher.checkpoint = task.checkpoint
+        game.searcher.cancel_token = cancel_token
+        try:
+            return game.response(budget, clock=task.clock)
+        finally:
+            game.searcher.checkpoint = None
+            game.searcher.cancel_token = None
+            self.scheduler.release(task)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+
+class TimeManager:
+    """
+    根据负载调整每一步的思考时间
+
+    目标是让每一步从排队到算完的时间不超过 `slo` 秒：
+
+    - 队列里有 n 个搜索时，每个搜索最多分到 slo / n 秒
+    - 最近的 p95 延迟超过 slo 时按比例继续压缩，明显低于 slo 时适当放宽
+    - 最后限制在 [min_think, max_think] 之内，对局自己的上下限优先
+
+    :param engine: 引擎计算队列
+    :param slo: 目标延迟（秒）
+    :param min_think: 最短思考时间（秒）
+    :param max_think: 最长思考时间（秒）
+    :param adaptive: 为 False 时不做调整，始终使用 `THINK_TIME`
+    """
+
+    def __init__(
+        self,
+        engine: Engine,
+        slo: float = 3,
+        min_think: float = 0.2,
+        max_think: float = 3,
+        adaptive: bool = True,
+    ):
+        self.engine = engine
+        self.slo = slo
+        self.min_think = min_think
+        self.max_think = max_think
+        self.adaptive = adaptive
+
+    def p95(self) -> float:
+        latencies = sorted(self.engine.latencies)
+        if not latencies:
+            return 0.0
+        return latencies[int(0.95 * (len(latencies) - 1))]
+
+    def budget(self, game=None) -> Optional[float]:
+        """
+        计算这一步的思考时间
+
+        :param game: ChessGame 对象，可以通过 min_think/max_think 设置本局的上下限
+        :return: 思考时间（秒），不做调整时返回 None
+        """
+        if not self.adaptive:
+            return None
+        budget = self.slo / max(1, self.engine.pending)
+        p95 = self.p95()
+        if p95 > 0:
+            budget *= min(2.0, max(0.25, self.slo / p95))
+        low = self.min_think
+        high = self.max_think
+        if game is not None:
+            if game.min_think is not None:
+                low = game.min_think
+            if game.max_think is not None:
+                high = game.max_think
+        budget = min(high, max(low, budget))
+        think_budget.observe(budget)
+        return budget
+
+
+class Task:
+    """
+    分时模式下的一次搜索
+
+    :param deadline: 截止时间（time.monotonic）
+    :param budget: 预计要占用的 CPU 时间（秒）
+    """
+
+    def __init__(self, deadline: float, budget: float):
+        self.deadline = deadline
+        self.budget = budget
+        self.scheduler: Optional["Scheduler"] = None
+        self.used = 0.0  # 已经占用 CPU 的时间
+        self.resumed: Optional[float] = None  # 这次拿到 CPU 的时刻，没在算时为 None
+
+    def clock(self) -> float:
+        """
+        本次搜索占用 CPU 的时间，代替 time.time 给 ChessGame.think 计时
+        """
+        if self.resumed is None:
+            return self.used
+        return self.used + time.monotonic() - self.resumed
+
+    def urgent(self, now: float) -> bool:
+        """
+        按预算算完就会超过截止时间。已经用完预算的（例如按难度等级搜索的）不算，
+        否则它会一直排在最前面
+        """
+        return self.used < self.budget and self.deadline - now < self.budget - self.used
+
+    def checkpoint(self):
+        """
+        由 Searcher 每隔一段节点调用，时间片用完时让出 CPU
+        """
+        self.scheduler.checkpoint(self)
+
+
+class Scheduler:
+    """
+    在一个进程里轮流执行多个搜索
+
+    每个搜索在自己的线程里运行，但只有 `running` 可以计算，其余的线程在
+    `checkpoint` 里等待。时间片用完时重新选择：
+
+    - 快要超过截止时间的搜索（`Task.urgent`）优先，其中截止时间最早的先算；
+    - 否则选占用 CPU 时间最少的，新来的搜索很快就能开始。
+
+    :param quantum: 时间片（秒）
+    """
+
+    def __init__(self, quantum: float = 0.05):
+        self.quantum = quantum
+        self.cond = threading.Condition()
+        self.ready: List[Task] = []  # 等待 CPU 的搜索
+        self.running: Optional[Task] = None
+        self.switches = 0
+
+    def _pick(self) -> Optional[Task]:
+        if not self.ready:
+            return None
+        now = time.monotonic()
+        urgent = [task for task in self.ready if task.urgent(now)]
+        if urgent:
+            return min(urgent, key=lambda task: task.deadline)
+        return min(self.ready, key=lambda task: (task.used, task.deadline))
+
+    def _dispatch(self):
+        # 调用时持有 cond，并且没有正在计算的搜索
+        task = self._pick()
+        if task is not None:
+            self.ready.remove(task)
+            self.running = task
+            self.cond.notify_all()
+
+    def _wait(self, task: Task):
+        while self.running is not task:
+            self.cond.wait()
+        task.resumed = time.monotonic()
+
+    def _suspend(self, task: Task):
+        task.used += time.monotonic() - task.resumed
+        task.resumed = None
+        self.running = None
+
+    def acquire(self, task: Task):
+        """
+        等到轮到这个搜索
+        """
+        task.scheduler = self
+        with self.cond:
+            self.ready.append(task)
+            if self.running is None:
+                self._dispatch()
+            self._wait(task)
+
+    def checkpoint(self, task: Task):
+        """
+        时间片用完、又有别的搜索在等待时，把 CPU 交给调度器选中的搜索
+        """
+        if not self.ready or time.monotonic() - task.resumed < self.quantum:
+            return
+        with self.cond:
+            self._suspend(task)
+            self.ready.append(task)
+            self._dispatch()
+            if self.running is not task:
+                self.switches += 1
+                engine_switches.inc()
+            self._wait(task)
+
+    def release(self, task: Task):
+        """
+        搜索结束，把 CPU 交给下一个
+        """
+        with self.cond:
+            self._suspend(task)
+            self._dispatch()
+
+
+def create_engine(config: Dict[str, Any]) -> Engine:
+    """
+    根据配置文件中的 `engine` 一节创建引擎计算队列
+
+    :param config: 配置文件内容
+    """
+    options = dict(config.get("engine") or {})
+    engine = Engine(
+        options.pop("workers", 1),
+        sliced=options.pop("sliced", False),
+        quantum=options.pop("quantum", 0.05),
+    )
+    engine.timeman = TimeManager(engine, **options)
+    return engine
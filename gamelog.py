@@ -0,0 +1,360 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+gamelog.py: 棋谱记录
+
+机器人下完的每一局都写成 PGN 棋谱（着法用 ICCS 坐标，例如 `H2-E2`），
+追加到按大小和时间轮转的 gzip 文件里：
+
+    [Game "Chinese Chess"]
+    [Date "2026.10.19"]
+    [Red "1234567"]
+    [Black "elephantfish"]
+    [Result "0-1"]
+    [Format "ICCS"]
+
+    1. H2-E2 H9-G7 2. H0-G2 I9-H9 0-1
+
+`GameLog.write` 只是把棋谱放进队列，压缩和写文件在后台线程里进行，不会阻塞下棋；
+队列满了（磁盘太慢）时丢弃棋谱而不是等待。每写完一局都会 flush 一次，
+正在写的文件也能读出已经写完的对局。
+
+`iter_games` 逐局读取棋谱文件或目录，可以用于生成开局库、调参和回放测试：
+
+    for game in iter_games("data/games"):
+        for pos, move in game.replay():
+            ...
+
+author: wzpan
+email: m@hahack.com
+"""
+import glob
+import gzip
+import logging
+import os
+import queue
+import re
+import threading
+import time
+import zlib
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+import elephantfish
+import metrics
+import tools
+
+# 与 qqbot.logger 是同一个 logger，写进机器人的日志，又不必为此依赖 qqbot
+logger = logging.getLogger("qqbot")
+
+games_total = metrics.counter("chess_gamelog_games_total", "Games written to the log")
+dropped_total = metrics.counter(
+    "chess_gamelog_dropped_total", "Games dropped because the log queue was full"
+)
+
+FORMAT = "ICCS"
+RESULTS = ("1-0", "0-1", "1/2-1/2", "*")
+
+_HEADER = re.compile(r'\[(\w+)\s+"(.*)"\]')
+_ICCS = re.compile(r"^([A-I][0-9])-([A-I][0-9])$")
+_COMMENT = re.compile(r"\{[^}]*\}|;[^\n]*")
+
+
+################################################################################
+# 着法和棋谱的文本格式
+################################################################################
+
+
+def render_iccs(move: str) -> str:
+    """
+    把 `h2e2` 形式的着法转成 ICCS 的 `H2-E2`
+    """
+    return "{}-{}".format(move[:2].upper(), move[2:4].upper())
+
+
+def parse_iccs(text: str) -> str:
+    """
+    把 ICCS 的 `H2-E2` 转成 `h2e2`
+
+    :raises ValueError: 不是 ICCS 着法
+    """
+    match = _ICCS.match(text.upper())
+    if not match:
+        raise ValueError("不是 ICCS 着法: {}".format(text))
+    return (match.group(1) + match.group(2)).lower()
+
+
+@dataclass
+class Game:
+    """
+    一局棋
+
+    :param moves: 着法，`h2e2` 的形式，红方在下的坐标
+    :param result: "1-0"、"0-1"、"1/2-1/2" 或 "*"
+    :param headers: 其它 PGN 标签
+    """
+
+    moves: List[str]
+    result: str = "*"
+    headers: Dict[str, str] = field(default_factory=dict)
+
+    @property
+    def fen(self) -> str:
+        return self.headers.get("FEN", tools.FEN_INITIAL)
+
+    def replay(self) -> Iterator[Tuple[elephantfish.Position, Tuple[int, int]]]:
+        """
+        依次产生 (局面, 在该局面走的着法)，遇到不合法的着法时停止
+        """
+        pos = tools.parseFEN(self.fen)
+        color = tools.WHITE if self.fen.split()[1] == "w" else tools.BLACK
+        for text in self.moves:
+            move = tools.mparse(color, text)
+            if move not in pos.gen_moves():
+                return
+            yield pos, move
+            pos, color = pos.move(move), 1 - color
+
+    def to_pgn(self) -> str:
+        headers = {"Game": "Chinese Chess", **self.headers}
+        headers["Result"] = self.result
+        headers["Format"] = FORMAT
+        lines = [
+            '[{} "{}"]'.format(k, str(v).replace('"', "'")) for k, v in headers.items()
+        ]
+        black_first = self.fen.split()[1] == "b"
+        tokens = []
+        for i, move in enumerate(self.moves):
+            ply = i + black_first
+            if ply % 2 == 0:
+                tokens.append("{}.".format(ply // 2 + 1))
+            elif i == 0:
+                tokens.append("{}. ...".format(ply // 2 + 1))
+            tokens.append(render_iccs(move))
+        tokens.append(self.result)
+        # 着法部分每行不超过 80 个字符
+        text, line = [], ""
+        for token in tokens:
+            if line and len(line) + 1 + len(token) > 80:
+                text.append(line)
+                line = token
+            else:
+                line = "{} {}".format(line, token) if line else token
+        text.append(line)
+        return "\n".join(lines) + "\n\n" + "\n".join(text) + "\n\n"
+
+
+def parse_games(lines: Iterable[str]) -> Iterator[Game]:
+    """
+    从 PGN 文本行中逐局解析棋谱
+
+    只认 ICCS 着法；中文纵线记法的棋谱会被跳过。
+    """
+    headers: Dict[str, str] = {}
+    movetext: List[str] = []
+
+    def finish():
+        text = _COMMENT.sub(" ", " ".join(movetext))
+        moves, result = [], headers.get("Result", "*")
+        for token in text.split():
+            if token in RESULTS:
+                result = token
+            elif token[0].isdigit() or token == "...":
+                continue
+            else:
+                try:
+                    moves.append(parse_iccs(token))
+                except ValueError:
+                    return None
+        return Game(moves, result, dict(headers))
+
+    for line in lines:
+        line = line.strip()
+        if line.startswith("["):
+            if movetext:
+                game = finish()
+                if game is not None:
+                    yield game
+                headers, movetext = {}, []
+            match = _HEADER.match(line)
+            if match:
+                headers[match.group(1)] = match.group(2)
+        elif line:
+            movetext.append(line)
+    if headers or movetext:
+        game = finish()
+        if game is not None:
+            yield game
+
+
+def _open(path: str):
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8")
+    return open(path, encoding="utf-8")
+
+
+def _tolerant(lines: Iterable[str]) -> Iterator[str]:
+    # 正在写的 gzip 文件还没有结尾，读到末尾时会报 EOFError，已经读出的对局都是完整的
+    try:
+        yield from lines
+    except EOFError:
+        return
+
+
+def expand_paths(paths: Union[str, Iterable[str]]) -> List[str]:
+    """
+    把文件和目录展开成棋谱文件列表，目录下的文件按名字（也就是时间）排序
+    """
+    if isinstance(paths, str):
+        paths = [paths]
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += sorted(
+                glob.glob(os.path.join(path, "*.pgn"))
+                + glob.glob(os.path.join(path, "*.pgn.gz"))
+            )
+        else:
+            files.append(path)
+    return files
+
+
+def is_game_file(path: str) -> bool:
+    return os.path.isdir(path) or path.endswith((".pgn", ".pgn.gz"))
+
+
+def iter_games(paths: Union[str, Iterable[str]]) -> Iterator[Game]:
+    """
+    逐局读取棋谱，内存占用与文件大小无关
+
+    :param paths: 棋谱文件（.pgn 或 .pgn.gz）或目录
+    """
+    for path in expand_paths(paths):
+        with _open(path) as f:
+            yield from parse_games(_tolerant(f))
+
+
+################################################################################
+# 后台写入
+################################################################################
+
+
+class GameLog:
+    """
+    在后台线程里把棋谱写到轮转的 gzip 文件
+
+    文件名为 `games-<开始时间>.pgn.gz`，超过 max_bytes（压缩前）或 max_age 秒以后换一个新文件。
+
+    :param directory: 棋谱目录
+    :param max_bytes: 每个文件最多写入的字节数
+    :param max_age: 每个文件最多写多少秒
+    :param max_files: 最多保留多少个文件，0 表示不删除
+    :param queue_size: 等待写入的对局数上限
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        max_bytes: int = 16 * 1024 * 1024,
+        max_age: float = 86400,
+        max_files: int = 0,
+        queue_size: int = 1000,
+    ):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.max_files = max_files
+        self.queue: "queue.Queue[Optional[Game]]" = queue.Queue(queue_size)
+        self.file = None
+        self.path = None
+        self.opened = 0.0
+        self.written = 0
+        self.games = 0
+        self.dropped = 0
+        os.makedirs(directory, exist_ok=True)
+        self.thread = threading.Thread(target=self._run, name="gamelog", daemon=True)
+        self.thread.start()
+
+    @property
+    def pending(self) -> int:
+        return self.queue.qsize()
+
+    def write(self, game: Game):
+        """
+        把一局棋放进写入队列，立即返回
+        """
+        try:
+            self.queue.put_nowait(game)
+        except queue.Full:
+            self.dropped += 1
+            dropped_total.inc()
+
+    def close(self):
+        """
+        写完队列里的对局，关闭文件
+        """
+        self.queue.put(None)
+        self.thread.join()
+
+    def _rotate(self):
+        if self.file is not None:
+            self.file.close()
+        name = time.strftime("games-%Y%m%d-%H%M%S", time.localtime())
+        path = os.path.join(self.directory, name + ".pgn.gz")
+        n = 1
+        while os.path.exists(path):
+            path = os.path.join(self.directory, "{}-{}.pgn.gz".format(name, n))
+            n += 1
+        self.path = path
+        self.file = gzip.open(path, "wb")
+        self.opened = time.time()
+        self.written = 0
+        if self.max_files:
+            files = sorted(expand_paths(self.directory), key=os.path.getmtime)
+            for old in files[: max(0, len(files) - self.max_files)]:
+                os.remove(old)
+
+    def _write(self, game: Game):
+        if (
+            self.file is None
+            or self.written >= self.max_bytes
+            or time.time() - self.opened >= self.max_age
+        ):
+            self._rotate()
+        data = game.to_pgn().encode("utf-8")
+        self.file.write(data)
+        # 同步刷新，读取时能解压出已经写完的对局
+        self.file.flush(zlib.Z_SYNC_FLUSH)
+        self.written += len(data)
+        self.games += 1
+        games_total.inc()
+
+    def _run(self):
+        while True:
+            game = self.queue.get()
+            if game is None:
+                break
+            try:
+                self._write(game)
+            except OSError as e:
+                self.dropped += 1
+                dropped_total.inc()
+                logger.warning("写棋谱失败: %s" % e)
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def create_gamelog(config: Dict[str, Any], base: str = "") -> Optional[GameLog]:
+    """
+    根据配置文件中的 `gamelog` 一节创建棋谱记录
+
+    :param config: 配置文件内容
+    :param base: 相对路径的起点
+    :return: 没有配置或 enable 为 false 时返回 None
+    """
+    options = dict(config.get("gamelog") or {})
+    if not options.pop("enable", False):
+        return None
+    directory = os.path.join(base, options.pop("path", "data/games"))
+    return GameLog(directory, **options)
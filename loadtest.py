@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+loadtest.py: 机器人的离线压测工具
+
+用假的消息接口代替 qqbot 网关，模拟大量子频道同时下棋：
+每个子频道从 random_openings.fen 里随机选一个开局，然后不停地走随机的合法着法，
+直接调用 `ChineseChessBot.handle_message`。逐级增加子频道数，统计每一级的
+
+- 端到端延迟（从收到消息到回复发出）的 p50/p95/p99
+- 引擎排队时间的 p50/p95/p99
+- 吞吐量（每秒完成的着法数）
+- 内存增长
+- 共享结果缓存的命中率
+
+用法：
+
+    python loadtest.py --channels 10,50,100,500 --moves 5 --slo 1
+
+加上 `--sliced 64` 用分时模式的引擎（最多 64 个搜索轮流计算）做对比。
+
+author: wzpan
+email: m@hahack.com
+"""
+import argparse
+import asyncio
+import logging
+import os
+import random
+import time
+from collections import defaultdict
+from typing import Dict, List
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = min(len(values) - 1, max(0, int(round(p / 100 * (len(values) - 1)))))
+    return values[k]
+
+
+def rss_mb() -> float:
+    """
+    当前进程的常驻内存（MB）
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class FakeMessageAPI:
+    """
+    假的消息接口，记录每条被回复消息最后一次收到回复的时间
+    """
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.replied: Dict[str, float] = {}
+        self.posts = 0
+
+    async def _post(self, send):
+        if self.latency:
+            await asyncio.sleep(random.uniform(0.5, 1.5) * self.latency)
+        self.posts += 1
+        self.replied[send.msg_id] = time.monotonic()
+
+    async def post_message(self, channel_id, send):
+        await self._post(send)
+
+    async def post_direct_message(self, guild_id, send):
+        await self._post(send)
+
+
+class FakeClient:
+    def __init__(self, latency: float):
+        self.message_api = self.dms_api = FakeMessageAPI(latency)
+
+
+class Player:
+    """
+    一个模拟的子频道，自己开局并随机走棋
+    """
+
+    def __init__(self, bot, index: int, openings: List[str], stats):
+        import qqbot
+
+        self.qqbot = qqbot
+        self.bot = bot
+        self.channel_id = "channel-%d" % index
+        self.user_id = "user-%d" % index
+        self.openings = openings
+        self.stats = stats
+        self.seq = 0
+
+    def message(self, content: str):
+        self.seq += 1
+        message = self.qqbot.Message()
+        message.id = "%s-%d" % (self.channel_id, self.seq)
+        message.channel_id = self.channel_id
+        message.guild_id = "guild"
+        message.content = content
+        message.author = self.qqbot.User()
+        message.author.id = self.user_id
+        return message
+
+    async def say(self, content: str) -> float:
+        """
+        发一条消息，等到它的回复全部发出，返回端到端延迟
+        """
+        event = "AT_MESSAGE_CREATE"
+        message = self.message("<@!1234> " + content)
+        start = time.monotonic()
+        await self.bot.handle_message(event, message)
+        await self.bot.outbox.drain(event, message)
+        replied = self.bot.client.message_api.replied.pop(message.id, start)
+        return replied - start
+
+    def legal_moves(self):
+        import tools
+
+        game = self.bot.game_data[self.channel_id]["game"]
+        return [
+            game.render(i) + game.render(j)
+            for (i, j), _ in tools.gen_legal_moves(game.hist[-1])
+        ]
+
+    async def start(self):
+        import tools
+
+        await self.say("/开局")
+        game = self.bot.game_data[self.channel_id]["game"]
+        game.setup(tools.parseFEN(random.choice(self.openings)))
+
+    async def play(self, moves: int):
+        await self.start()
+        for _ in range(moves):
+            if self.channel_id not in self.bot.game_data:
+                await self.start()
+            candidates = self.legal_moves()
+            if not candidates:
+                await self.say("/投降")
+                continue
+            latency = await self.say("/下棋 " + random.choice(candidates))
+            self.stats["latency"].append(latency)
+            self.stats["moves"] += 1
+        if self.channel_id in self.bot.game_data:
+            await self.say("/投降")
+
+
+async def run_stage(bot, channels: int, moves: int, openings: List[str], offset: int):
+    stats = defaultdict(list)
+    stats["moves"] = 0
+    bot.engine.waits.clear()
+    players = [Player(bot, offset + i, openings, stats) for i in range(channels)]
+    rss_before = rss_mb()
+    cache = bot.cache
+    lookups, hits = (cache.lookups, cache.hits) if cache else (0, 0)
+    start = time.monotonic()
+    await asyncio.gather(*(player.play(moves) for player in players))
+    elapsed = time.monotonic() - start
+    latency = stats["latency"]
+    waits = list(bot.engine.waits)
+    return {
+        "channels": channels,
+        "moves": stats["moves"],
+        "elapsed": elapsed,
+        "throughput": stats["moves"] / elapsed if elapsed else 0,
+        "p50": percentile(latency, 50),
+        "p95": percentile(latency, 95),
+        "p99": percentile(latency, 99),
+        "wait_p50": percentile(waits, 50),
+        "wait_p95": percentile(waits, 95),
+        "wait_p99": percentile(waits, 99),
+        "rss": rss_mb(),
+        "rss_delta": rss_mb() - rss_before,
+        "hit_rate": (
+            (cache.hits - hits) / (cache.lookups - lookups) * 100
+            if cache and cache.lookups > lookups
+            else 0.0
+        ),
+    }
+
+
+def report(row: Dict[str, float]):
+    print(
+        "{channels:>8} {moves:>7} {throughput:>9.2f} "
+        "{p50:>7.3f} {p95:>7.3f} {p99:>7.3f} "
+        "{wait_p50:>7.3f} {wait_p95:>7.3f} {wait_p99:>7.3f} "
+        "{rss:>8.1f} {rss_delta:>+8.1f} {hit_rate:>6.1f}".format(**row),
+        flush=True,
+    )
+
+
+async def main(args):
+    # 导入 bot 之前先指定配置文件，bot 模块在导入时就会读取配置
+    os.environ["CHESS_BOT_CONFIG"] = args.config
+    import qqbot
+
+    qqbot.logger.setLevel(logging.WARNING)
+
+    import chess
+    from bot import bot
+    from engine import Engine
+    from outbox import TokenBucket
+    from resultcache import ResultCache
+
+    if args.sliced:
+        timeman = bot.engine.timeman
+        bot.engine.shutdown()
+        bot.engine = Engine(args.sliced, sliced=True)
+        timeman.engine = bot.engine
+        bot.engine.timeman = timeman
+
+    # 随机着法的对局不读也不写线上的快照
+    if args.no_cache or bot.cache is None:
+        bot.cache = None
+    else:
+        bot.cache = ResultCache(bot.cache.max_entries)
+    # 随机开局、随机着法的对局也不写进线上的棋谱
+    bot.gamelog = None
+
+    if args.think_time is not None:
+        chess.THINK_TIME = args.think_time
+        bot.engine.timeman.adaptive = False
+    if args.slo is not None:
+        bot.engine.timeman.slo = args.slo
+    bot.client = bot.outbox.client = FakeClient(args.api_latency)
+    if args.no_rate_limit:
+        bot.outbox.channel_rate = bot.outbox.channel_burst = 1e9
+        bot.outbox.global_bucket = TokenBucket(1e9, 1e9)
+
+    with open(args.fen) as f:
+        openings = [line.strip() for line in f if line.strip()]
+
+    print(
+        "{:>8} {:>7} {:>9} {:>7} {:>7} {:>7} {:>7} {:>7} {:>7} {:>8} {:>8} {:>6}".format(
+            "channels",
+            "moves",
+            "moves/s",
+            "p50",
+            "p95",
+            "p99",
+            "wait50",
+            "wait95",
+            "wait99",
+            "rss(MB)",
+            "delta",
+            "hit%",
+        )
+    )
+    offset = 0
+    for channels in args.channels:
+        report(await run_stage(bot, channels, args.moves, openings, offset))
+        offset += channels
+    bot.engine.shutdown()
+
+
+def parse_args():
+    default_config = os.path.join(HERE, "config.yml")
+    if not os.path.exists(default_config):
+        default_config = os.path.join(HERE, "config.example.yml")
+    parser = argparse.ArgumentParser(description="机器人离线压测")
+    parser.add_argument(
+        "--channels",
+        type=lambda s: [int(n) for n in s.split(",")],
+        default=[10, 50, 100, 500],
+        help="逐级增加的子频道数，用逗号分隔",
+    )
+    parser.add_argument("--moves", type=int, default=5, help="每个子频道走的步数")
+    parser.add_argument(
+        "--think-time",
+        type=float,
+        default=None,
+        help="使用固定的思考时间（秒），不再根据负载调整",
+    )
+    parser.add_argument(
+        "--slo", type=float, default=None, help="覆盖引擎的目标延迟（秒）"
+    )
+    parser.add_argument(
+        "--sliced",
+        type=int,
+        default=0,
+        metavar="WORKERS",
+        help="使用分时模式的引擎，最多同时进行 WORKERS 个搜索",
+    )
+    parser.add_argument(
+        "--no-cache", action="store_true", help="不使用跨对局共享的结果缓存"
+    )
+    parser.add_argument(
+        "--api-latency", type=float, default=0.05, help="假消息接口的平均延迟（秒）"
+    )
+    parser.add_argument(
+        "--no-rate-limit", action="store_true", help="关闭出站消息队列的限流"
+    )
+    parser.add_argument(
+        "--fen",
+        default=os.path.join(HERE, "data", "fen", "random_openings.fen"),
+        help="开局局面文件",
+    )
+    parser.add_argument("--config", default=default_config, help="配置文件")
+    parser.add_argument("--seed", type=int, default=None, help="随机数种子")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    random.seed(args.seed)
+    asyncio.run(main(args))
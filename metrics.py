@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+metrics.py: 运行指标
+
+指标平时只是内存里的几个数字，记录一次只有一次加法（直方图多一次二分查找）；
+需要实时计算的指标（例如对局数、置换表大小）注册成回调，只在被抓取时才计算。
+
+两种导出方式，都在后台线程里进行，不占用事件循环：
+
+- `serve(host, port)`：Prometheus 文本格式，地址为 /metrics ，JSON 格式为 /metrics.json
+- `dump_json(path, interval)`：定期把指标写到 JSON 文件
+
+author: wzpan
+email: m@hahack.com
+"""
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, List, Sequence
+
+# 默认的耗时直方图分桶（秒）
+TIME_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Counter:
+    def __init__(self, name: str, doc: str):
+        self.name = name
+        self.doc = doc
+        self.value = 0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def samples(self):
+        yield self.name, "", self.value
+
+    def snapshot(self):
+        return self.value
+
+
+class Gauge:
+    """
+    仪表盘指标，可以直接设置值，也可以给一个只在抓取时调用的回调
+    """
+
+    def __init__(self, name: str, doc: str, func: Callable[[], float] = None):
+        self.name = name
+        self.doc = doc
+        self.func = func
+        self.value = 0
+
+    def set(self, value: float):
+        self.value = value
+
+    def get(self) -> float:
+        return self.func() if self.func else self.value
+
+    def samples(self):
+        yield self.name, "", self.get()
+
+    def snapshot(self):
+        return self.get()
+
+
+class Histogram:
+    def __init__(self, name: str, doc: str, buckets: Sequence[float] = TIME_BUCKETS):
+        self.name = name
+        self.doc = doc
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self):
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            yield self.name + "_bucket", '{le="%s"}' % bound, total
+        yield self.name + "_bucket", '{le="+Inf"}', self.count
+        yield self.name + "_sum", "", self.sum
+        yield self.name + "_count", "", self.count
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "mean": self.sum / self.count if self.count else 0,
+            "buckets": dict(zip(map(str, self.buckets), self.counts)),
+        }
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: Dict[str, Any] = {}
+        self.lock = threading.Lock()
+
+    def _register(self, metric):
+        with self.lock:
+            # 重复注册时返回已有的指标，方便多个模块共用
+            return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, doc: str) -> Counter:
+        return self._register(Counter(name, doc))
+
+    def gauge(self, name: str, doc: str, func: Callable[[], float] = None) -> Gauge:
+        gauge = self._register(Gauge(name, doc, func))
+        if func is not None:
+            gauge.func = func
+        return gauge
+
+    def histogram(
+        self, name: str, doc: str, buckets: Sequence[float] = TIME_BUCKETS
+    ) -> Histogram:
+        return self._register(Histogram(name, doc, buckets))
+
+    def to_prometheus(self) -> str:
+        lines: List[str] = []
+        for metric in list(self.metrics.values()):
+            kind = type(metric).__name__.lower()
+            lines.append("# HELP %s %s" % (metric.name, metric.doc))
+            lines.append("# TYPE %s %s" % (metric.name, kind))
+            for name, labels, value in metric.samples():
+                lines.append("%s%s %s" % (name, labels, value))
+        return "\n".join(lines) + "\n"
+
+    def to_dict(self) -> Dict[str, Any]:
+        data = {name: m.snapshot() for name, m in list(self.metrics.items())}
+        data["timestamp"] = time.time()
+        return data
+
+
+REGISTRY = Registry()
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
+
+# 搜索相关指标
+search_count = counter("chess_search_total", "Number of engine searches")
+search_nodes = counter("chess_search_nodes_total", "Nodes visited by all searches")
+search_qs_nodes = counter(
+    "chess_search_qs_nodes_total", "Quiescence nodes visited by all searches"
+)
+search_tt_hits = counter("chess_search_tt_hits_total", "Transposition table hits")
+search_tt_misses = counter("chess_search_tt_misses_total", "Transposition table misses")
+search_tt_overwrites = counter(
+    "chess_search_tt_overwrites_total", "Transposition table entries overwritten"
+)
+search_tb_hits = counter("chess_search_tb_hits_total", "Endgame tablebase hits")
+search_seconds = histogram("chess_search_seconds", "Wall time of each search")
+search_depth = histogram(
+    "chess_search_depth", "Depth reached by each search", range(1, 21)
+)
+search_nps = gauge("chess_search_nps", "Nodes per second of the last search")
+
+
+def observe_search(searcher, depth: int, elapsed: float):
+    """
+    记录一次搜索的统计
+
+    :param searcher: 完成搜索的 Searcher
+    :param depth: 达到的深度
+    :param elapsed: 耗时（秒）
+    """
+    search_count.inc()
+    search_nodes.inc(searcher.nodes)
+    search_qs_nodes.inc(searcher.qs_nodes)
+    search_tt_hits.inc(searcher.tt_hits)
+    search_tt_misses.inc(searcher.tt_misses)
+    search_tt_overwrites.inc(searcher.tt_overwrites)
+    search_tb_hits.inc(searcher.tb_hits)
+    search_seconds.observe(elapsed)
+    search_depth.observe(depth)
+    if elapsed > 0:
+        search_nps.set(searcher.nodes / elapsed)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path == "/metrics":
+            body = self.registry.to_prometheus().encode()
+            content_type = "text/plain; version=0.0.4; charset=utf-8"
+        elif self.path == "/metrics.json":
+            body = json.dumps(self.registry.to_dict()).encode()
+            content_type = "application/json"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(host: str = "127.0.0.1", port: int = 9108) -> ThreadingHTTPServer:
+    """
+    在后台线程里启动指标的 HTTP 服务
+
+    :param host: 监听地址
+    :param port: 监听端口
+    :return: HTTP 服务对象，可以调用 shutdown() 关闭
+    """
+    server = ThreadingHTTPServer((host, port), _Handler)
+    thread = threading.Thread(target=server.serve_forever, name="metrics", daemon=True)
+    thread.start()
+    return server
+
+
+def dump_json(path: str, interval: float = 60) -> threading.Thread:
+    """
+    在后台线程里定期把指标写到 JSON 文件
+
+    :param path: 文件路径
+    :param interval: 写入间隔（秒）
+    """
+
+    def loop():
+        while True:
+            time.sleep(interval)
+            tmp = path + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump(REGISTRY.to_dict(), f)
+            os.replace(tmp, path)
+
+    thread = threading.Thread(target=loop, name="metrics-dump", daemon=True)
+    thread.start()
+    return thread
+
+
+def start(config: Dict[str, Any]):
+    """
+    根据配置文件中的 `metrics` 一节启动指标导出
+    """
+    options = config.get("metrics") or {}
+    if not options.get("enable"):
+        return
+    if options.get("port"):
+        serve(options.get("host", "127.0.0.1"), options["port"])
+    if options.get("json_path"):
+        dump_json(options["json_path"], options.get("json_interval", 60))
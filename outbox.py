@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+outbox.py: 出站消息队列
+
+每个会话（子频道或私信）一个队列，由一个后台任务负责发送：
+
+- 队列里相邻且回复同一条消息的内容会合并成一次发送
+- 发送前按子频道和全局两级令牌桶限流
+- 发送失败时按指数退避重试
+
+处理指令的协程只负责把消息放进队列，不会被发送阻塞。
+
+author: wzpan
+email: m@hahack.com
+"""
+import asyncio
+import random
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, Deque, Dict, Tuple
+
+import aiohttp
+import qqbot
+from qqbot.core.exception.error import SequenceNumberError, ServerError
+
+import metrics
+from client import BotClient
+from utils import send_message
+
+send_seconds = metrics.histogram(
+    "chess_send_seconds", "Latency of each message API call"
+)
+send_delay_seconds = metrics.histogram(
+    "chess_send_delay_seconds", "Time from queuing a message until it was sent"
+)
+sent_total = metrics.counter("chess_sent_total", "Messages sent")
+merged_total = metrics.counter(
+    "chess_merged_total", "Messages merged into a previous send"
+)
+failed_total = metrics.counter("chess_send_failed_total", "Messages given up on")
+
+# 可以重试的错误。鉴权失败、找不到子频道之类的错误重试也没用，直接放弃
+RETRYABLE_ERRORS = (
+    SequenceNumberError,
+    ServerError,
+    aiohttp.ClientError,
+    asyncio.TimeoutError,
+)
+
+# 令牌桶少于这个数时不清理
+MIN_PRUNE = 1024
+
+
+class TokenBucket:
+    """
+    令牌桶限流
+
+    :param rate: 每秒补充的令牌数
+    :param burst: 桶的容量，也就是允许的突发量
+    """
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self) -> float:
+        """
+        距离下一个令牌可用还需要等待的秒数，0 表示现在就可以取
+        """
+        self._refill()
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self._refill()
+        self.tokens -= 1
+
+    def full(self) -> bool:
+        """
+        桶是否已经满了。满的桶和新建的桶没有区别，可以丢掉
+        """
+        self._refill()
+        return self.tokens >= self.burst
+
+
+@dataclass
+class OutMessage:
+    content: str
+    event: str
+    message: qqbot.Message
+    queued: float
+
+    @property
+    def reply_to(self) -> Tuple[str, str]:
+        return self.event, self.message.id
+
+
+class Outbox:
+    """
+    一个机器人的出站消息队列
+    """
+
+    def __init__(
+        self,
+        client: BotClient,
+        channel_rate: float = 1,
+        channel_burst: float = 5,
+        global_rate: float = 20,
+        global_burst: float = 40,
+        max_retries: int = 3,
+        backoff_base: float = 0.5,
+        backoff_max: float = 8,
+        coalesce_delay: float = 0,
+        max_length: int = 2000,
+    ):
+        self.client = client
+        self.channel_rate = channel_rate
+        self.channel_burst = channel_burst
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.coalesce_delay = coalesce_delay
+        self.max_length = max_length
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.queues: Dict[Tuple[str, str], Deque[OutMessage]] = {}
+        self.buckets: Dict[Tuple[str, str], TokenBucket] = {}
+        # 令牌桶数达到这个数时清理一次空闲的桶，见 `_prune_buckets`
+        self._prune_at = MIN_PRUNE
+        self.workers: Dict[Tuple[str, str], asyncio.Task] = {}
+        self.sent = 0
+        self.merged = 0
+        self.failed = 0
+
+    @staticmethod
+    def _target(event: str, message: qqbot.Message) -> Tuple[str, str]:
+        if event == "DIRECT_MESSAGE_CREATE":
+            return event, message.guild_id
+        return event, message.channel_id
+
+    @property
+    def pending(self) -> int:
+        return sum(len(queue) for queue in self.queues.values())
+
+    def send(self, content: str, event: str, message: qqbot.Message):
+        """
+        把消息放进发送队列，立即返回
+
+        :param content: 发消息的内容
+        :param event: 事件名
+        :param message: 要回复的 qqbot.Message 消息体
+        """
+        target = self._target(event, message)
+        queue = self.queues.setdefault(target, deque())
+        queue.append(OutMessage(content, event, message, time.monotonic()))
+        if target not in self.workers:
+            self.workers[target] = asyncio.get_running_loop().create_task(
+                self._work(target)
+            )
+
+    async def flush(self):
+        """
+        等待所有队列发送完毕
+        """
+        while self.workers:
+            await asyncio.gather(*self.workers.values(), return_exceptions=True)
+
+    async def drain(self, event: str, message: qqbot.Message):
+        """
+        等待某个会话的队列发送完毕
+
+        :param event: 事件名
+        :param message: 该会话中的任意一条 qqbot.Message
+        """
+        target = self._target(event, message)
+        while target in self.workers:
+            await asyncio.shield(self.workers[target])
+
+    def _pop_batch(self, queue: Deque[OutMessage]) -> OutMessage:
+        """
+        取出队首的消息，并把紧跟其后、回复同一条消息的内容合并进来
+        """
+        first = queue.popleft()
+        parts = [first.content]
+        length = len(first.content)
+        while queue and queue[0].reply_to == first.reply_to:
+            length += len(queue[0].content) + 2
+            if length > self.max_length:
+                break
+            parts.append(queue.popleft().content)
+        if len(parts) > 1:
+            self.merged += len(parts) - 1
+            merged_total.inc(len(parts) - 1)
+            first.content = "\n\n".join(parts)
+        return first
+
+    def _prune_buckets(self):
+        """
+        丢掉没有待发消息、令牌已经补满的桶，令牌桶数不会随服务过的子频道数无限增长
+
+        每次清理后下一次清理的门槛翻倍，均摊到每个新建的桶上是常数时间
+        """
+        for target in [
+            target
+            for target, bucket in self.buckets.items()
+            if target not in self.queues and bucket.full()
+        ]:
+            del self.buckets[target]
+        self._prune_at = max(MIN_PRUNE, 2 * len(self.buckets))
+
+    async def _acquire(self, bucket: TokenBucket):
+        while True:
+            delay = max(bucket.delay(), self.global_bucket.delay())
+            if delay <= 0:
+                bucket.take()
+                self.global_bucket.take()
+                return
+            await asyncio.sleep(delay)
+
+    async def _deliver(self, item: OutMessage):
+        for attempt in range(self.max_retries + 1):
+            try:
+                start = time.monotonic()
+                await send_message(self.client, item.content, item.event, item.message)
+                now = time.monotonic()
+                send_seconds.observe(now - start)
+                send_delay_seconds.observe(now - item.queued)
+                sent_total.inc()
+                self.sent += 1
+                return
+            except RETRYABLE_ERRORS as e:
+                if attempt == self.max_retries:
+                    raise
+                backoff = min(self.backoff_max, self.backoff_base * 2**attempt)
+                backoff *= random.uniform(0.5, 1)
+                qqbot.logger.warning("发送消息失败，%.2f 秒后重试: %s" % (backoff, e))
+                await asyncio.sleep(backoff)
+
+    async def _work(self, target: Tuple[str, str]):
+        queue = self.queues[target]
+        bucket = self.buckets.get(target)
+        if bucket is None:
+            if len(self.buckets) >= self._prune_at:
+                self._prune_buckets()
+            bucket = self.buckets[target] = TokenBucket(
+                self.channel_rate, self.channel_burst
+            )
+        try:
+            while queue:
+                if self.coalesce_delay:
+                    await asyncio.sleep(self.coalesce_delay)
+                await self._acquire(bucket)
+                item = self._pop_batch(queue)
+                try:
+                    await self._deliver(item)
+                except Exception as e:
+                    self.failed += 1
+                    failed_total.inc()
+                    qqbot.logger.error("发送消息失败，已放弃: %s" % e)
+        finally:
+            del self.workers[target]
+            if not queue:
+                del self.queues[target]
+
+
+def create_outbox(client: BotClient, config: Dict[str, Any]) -> Outbox:
+    """
+    根据配置文件中的 `outbox` 一节创建出站队列
+
+    :param client: 机器人的 API 客户端
+    :param config: 配置文件内容
+    """
+    return Outbox(client, **(config.get("outbox") or {}))
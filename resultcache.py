@@ -0,0 +1,418 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+resultcache.py: 跨对局共享的搜索结果缓存
+
+每个子频道的 `ChessGame` 都有自己的 `Searcher`，置换表不互通，
+而成千上万局棋会反复走到同样的开局和中局局面。这里按 `Position.zobrist()`
+记下每个局面搜索完成的最深一层的结果（着法、分数、深度、边界类型），
+进程内所有对局共用：
+
+- 缓存的深度够用时直接走缓存里的着法，不再搜索；
+- 深度不够时把缓存的着法作为根节点第一个搜索的着法，搜索完再写回更深的结果。
+
+条目数超过 `max_entries` 时淘汰最久没有用到的条目（LRU）。
+搜索在引擎线程里进行，读写都加锁。
+
+配置了快照文件时，缓存会定期和在退出时保存到磁盘，重新部署以后用 mmap 打开，
+内存里没有的局面再到快照里二分查找，不用从头积累。快照的格式：
+
+    文件头  magic(8s) version(I) record_size(I) 引擎指纹(16s) count(Q)
+    记录    key(Q) from(B) to(B) depth(B) bound(B) score(h)
+
+记录按 key 排序。引擎指纹是 elephantfish 源码和 Zobrist 随机数的哈希，
+引擎改过（评估变了，或者 key 的含义变了）以后旧的快照不会被使用。
+
+author: wzpan
+email: m@hahack.com
+"""
+import atexit
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from functools import lru_cache
+from typing import Any, Callable, Dict, Iterable, Iterator, Optional, Tuple
+
+import elephantfish
+import metrics
+
+# 与 qqbot.logger 是同一个 logger，写进机器人的日志，又不必为此依赖 qqbot
+logger = logging.getLogger("qqbot")
+
+lookups_total = metrics.counter(
+    "chess_result_cache_lookups_total", "Lookups in the shared result cache"
+)
+hits_total = metrics.counter(
+    "chess_result_cache_hits_total", "Moves played from the shared result cache"
+)
+partial_hits_total = metrics.counter(
+    "chess_result_cache_partial_hits_total",
+    "Cached results too shallow to play, used to order the search",
+)
+evictions_total = metrics.counter(
+    "chess_result_cache_evictions_total", "Entries evicted from the shared result cache"
+)
+snapshot_hits_total = metrics.counter(
+    "chess_result_cache_snapshot_hits_total",
+    "Lookups answered from the snapshot on disk",
+)
+
+# 边界类型。EXACT 是与对局历史无关的完整搜索结果，可以直接走；
+# LOWER 是受对局历史影响的结果，只用来引导搜索。搜索给出的分数本身是
+# MTD 的下界，与准确值相差不超过 EVAL_ROUGHNESS，只用于显示
+EXACT, LOWER, UPPER = range(3)
+
+# 着法用 (from, to) 表示，与 Position.gen_moves() 一致
+Move = Tuple[int, int]
+
+CachedResult = namedtuple("CachedResult", "move score depth bound")
+
+MAGIC = b"CCRESULT"
+VERSION = 2
+HEADER = struct.Struct("<8sII16sQ")
+RECORD = struct.Struct("<QBBBBh")
+KEY = struct.Struct("<Q")
+
+
+def better(entry: CachedResult, old: CachedResult) -> bool:
+    """
+    同一局面的新结果是否应该替换旧的
+
+    EXACT 的结果只会被更深的 EXACT 结果替换，其它的被同样深或更深的结果替换
+    """
+    if old.bound == EXACT:
+        return entry.bound == EXACT and entry.depth > old.depth
+    return entry.bound == EXACT or entry.depth >= old.depth
+
+
+class SnapshotError(Exception):
+    pass
+
+
+@lru_cache(maxsize=None)
+def engine_fingerprint() -> bytes:
+    """
+    引擎的指纹：elephantfish 源码和 Zobrist 随机数的哈希
+    """
+    digest = hashlib.sha1()
+    with open(elephantfish.__file__, "rb") as f:
+        digest.update(f.read())
+    for p in sorted(elephantfish.zobrist_keys):
+        digest.update(struct.pack("<256Q", *elephantfish.zobrist_keys[p]))
+    return digest.digest()[:16]
+
+
+class Snapshot:
+    """
+    只读的结果缓存快照
+
+    :param path: 快照文件路径
+    :raises SnapshotError: 不是快照文件、格式版本或引擎指纹不对、文件不完整
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < HEADER.size:
+                raise SnapshotError("{} 不是结果缓存快照".format(path))
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, version, record_size, fingerprint, self.count = HEADER.unpack_from(
+                self.mm, 0
+            )
+            if magic != MAGIC:
+                raise SnapshotError("{} 不是结果缓存快照".format(path))
+            if version != VERSION or record_size != RECORD.size:
+                raise SnapshotError(
+                    "{} 的格式版本是 {}，当前支持的是 {}".format(path, version, VERSION)
+                )
+            if fingerprint != engine_fingerprint():
+                raise SnapshotError("{} 是其它版本的引擎保存的".format(path))
+            if HEADER.size + self.count * RECORD.size != size:
+                raise SnapshotError("{} 不完整".format(path))
+        except SnapshotError:
+            self.mm.close()
+            raise
+
+    def __len__(self):
+        return self.count
+
+    def _key_at(self, index: int) -> int:
+        return KEY.unpack_from(self.mm, HEADER.size + index * RECORD.size)[0]
+
+    def lookup(self, key: int) -> Optional[CachedResult]:
+        """
+        二分查找一个局面
+
+        :param key: 局面的 Zobrist key
+        """
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key_at(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == self.count:
+            return None
+        k, i, j, depth, bound, score = RECORD.unpack_from(
+            self.mm, HEADER.size + lo * RECORD.size
+        )
+        if k != key:
+            return None
+        return CachedResult((i, j), score, depth, bound)
+
+    def __iter__(self) -> Iterator[Tuple[int, CachedResult]]:
+        """
+        按 key 的顺序遍历全部记录 (key, 结果)
+        """
+        for index in range(self.count):
+            k, i, j, depth, bound, score = RECORD.unpack_from(
+                self.mm, HEADER.size + index * RECORD.size
+            )
+            yield k, CachedResult((i, j), score, depth, bound)
+
+    def close(self):
+        self.mm.close()
+
+
+def write_snapshot(path: str, entries: Iterable[Tuple[int, CachedResult]]):
+    """
+    写快照文件。先写同目录下的临时文件再改名，正在读旧文件的进程不受影响，
+    同时写快照的进程也不会写进同一个临时文件
+
+    :param entries: (key, 结果) 的序列，key 不能重复
+    """
+    records = sorted(entries, key=lambda r: r[0])
+    fd, tmp = tempfile.mkstemp(
+        dir=os.path.dirname(path) or ".",
+        prefix=os.path.basename(path) + ".",
+        suffix=".tmp",
+    )
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(
+                HEADER.pack(
+                    MAGIC, VERSION, RECORD.size, engine_fingerprint(), len(records)
+                )
+            )
+            for key, (move, score, depth, bound) in records:
+                f.write(
+                    RECORD.pack(key, move[0], move[1], min(depth, 255), bound, score)
+                )
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+def open_snapshot(path: str) -> Optional[Snapshot]:
+    """
+    打开快照，文件不存在或者不能使用时返回 None
+    """
+    if not path or not os.path.exists(path):
+        return None
+    try:
+        return Snapshot(path)
+    except (SnapshotError, OSError, ValueError) as e:
+        logger.warning("不使用结果缓存快照: %s" % e)
+        return None
+
+
+class ResultCache:
+    """
+    按 Zobrist key 缓存根节点的搜索结果
+
+    :param max_entries: 最多缓存的局面数
+    :param snapshot: 快照文件路径，为空表示不保存
+    :param snapshot_entries: 快照最多保存的局面数，默认与 max_entries 相同
+    :param snapshot_interval: `autosave` 定期保存快照的间隔（秒），0 表示只在退出时保存
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 200000,
+        snapshot: str = "",
+        snapshot_entries: Optional[int] = None,
+        snapshot_interval: float = 600,
+    ):
+        self.max_entries = max_entries
+        self._data: "OrderedDict[int, CachedResult]" = OrderedDict()
+        self._lock = threading.Lock()
+        # 定期保存和退出时的保存可能同时进行，一次只保存一个
+        self._save_lock = threading.Lock()
+        self.snapshot_path = snapshot
+        self.snapshot_entries = snapshot_entries or max_entries
+        self.snapshot_interval = snapshot_interval
+        self.snapshot = open_snapshot(snapshot)
+        self.snapshot_hits = 0
+        self.lookups = 0
+        self.hits = 0
+        self.partial_hits = 0
+        self.stores = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    @property
+    def hit_rate(self) -> float:
+        """
+        直接走缓存着法的查询所占的比例
+        """
+        return self.hits / self.lookups if self.lookups else 0.0
+
+    def get(self, key: int) -> Optional[CachedResult]:
+        """
+        查询一个局面，不计入命中率。内存里没有时查快照，查到的放进内存
+        """
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                self._data.move_to_end(key)
+            elif self.snapshot is not None:
+                entry = self.snapshot.lookup(key)
+                if entry is not None:
+                    self.snapshot_hits += 1
+                    snapshot_hits_total.inc()
+                    self._insert(key, entry)
+            return entry
+
+    def probe(
+        self, key: int, depth: int, avoid: Optional[Callable[[Move], bool]] = None
+    ) -> Tuple[Optional[CachedResult], bool]:
+        """
+        查询一个局面并统计命中率
+
+        :param key: 局面的 Zobrist key
+        :param depth: 可以直接使用的最小深度
+        :param avoid: 对不能直接使用的着法返回 True，例如不合法的或者造成重复局面的
+        :return: (缓存的结果, 是否可以直接使用)，没有缓存时为 (None, False)
+        """
+        entry = self.get(key)
+        usable = (
+            entry is not None
+            and entry.depth >= depth
+            and entry.bound == EXACT
+            and not (avoid is not None and avoid(entry.move))
+        )
+        self.lookups += 1
+        lookups_total.inc()
+        if usable:
+            self.hits += 1
+            hits_total.inc()
+        elif entry is not None:
+            self.partial_hits += 1
+            partial_hits_total.inc()
+        return entry, usable
+
+    def put(self, key: int, move: Move, score: int, depth: int, bound: int = EXACT):
+        """
+        写入一个局面的搜索结果，不覆盖更好的结果，见 `better`
+        """
+        entry = CachedResult(move, score, depth, bound)
+        with self._lock:
+            old = self._data.get(key)
+            if old is not None and not better(entry, old):
+                self._data.move_to_end(key)
+                return
+            self._insert(key, entry)
+            self.stores += 1
+
+    def _insert(self, key: int, entry: CachedResult):
+        # 调用时持有锁
+        self._data[key] = entry
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_entries:
+            self._data.popitem(last=False)
+            self.evictions += 1
+            evictions_total.inc()
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def save(self):
+        """
+        把内存里的结果和旧的快照合并，写成新的快照
+
+        同一局面取较好的结果；超过 snapshot_entries 时保留最深的那些。
+        """
+        if not self.snapshot_path:
+            return
+        with self._save_lock:
+            with self._lock:
+                current = list(self._data.items())
+                old = self.snapshot
+            entries = dict(old) if old is not None else {}
+            for key, entry in current:
+                if key not in entries or better(entry, entries[key]):
+                    entries[key] = entry
+            items = entries.items()
+            if len(entries) > self.snapshot_entries:
+                items = sorted(items, key=lambda item: -item[1].depth)
+                items = items[: self.snapshot_entries]
+            write_snapshot(self.snapshot_path, items)
+            snapshot = open_snapshot(self.snapshot_path)
+            with self._lock:
+                self.snapshot = snapshot
+            if old is not None:
+                old.close()
+
+    def autosave(self):
+        """
+        每隔 snapshot_interval 秒和进程退出时保存快照，没有配置快照文件时什么也不做
+
+        由 `bot.run()` 调用，导入 bot 的压测等脚本不会写快照
+        """
+        if not self.snapshot_path:
+            return
+        if self.snapshot_interval:
+            self.save_periodically(self.snapshot_interval)
+        atexit.register(self.save)
+
+    def save_periodically(self, interval: float) -> threading.Thread:
+        """
+        在后台线程里定期保存快照
+
+        :param interval: 保存间隔（秒）
+        """
+
+        def loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.save()
+                except OSError as e:
+                    logger.warning("保存结果缓存快照失败: %s" % e)
+
+        thread = threading.Thread(target=loop, name="result-cache-save", daemon=True)
+        thread.start()
+        return thread
+
+
+def create_result_cache(
+    config: Dict[str, Any], base: str = ""
+) -> Optional[ResultCache]:
+    """
+    根据配置文件中的 `result_cache` 一节创建结果缓存
+
+    配置了快照文件时打开已有的快照；定期保存要另外调用 `ResultCache.autosave`。
+
+    :param config: 配置文件内容
+    :param base: 相对路径的起点
+    :return: 没有配置或 enable 为 false 时返回 None
+    """
+    options = dict(config.get("result_cache") or {})
+    if not options.pop("enable", False):
+        return None
+    if options.get("snapshot"):
+        options["snapshot"] = os.path.join(base, options["snapshot"])
+    return ResultCache(**options)
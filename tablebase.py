@@ -0,0 +1,572 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+tablebase.py: 残局库
+
+对子力很少的残局（例如 车 对 士象全 以外的 KR-KAB），离线用逆向分析算出每个局面的胜负和
+距离，搜索时遇到子力匹配的局面直接返回准确的分数，不需要再往下搜索。
+
+每种子力组合一个文件，文件名是子力签名，例如 `KR-KAB.tb` 表示轮到走棋的一方有帅、车，
+对方有将、士、象。文件由文件头和每个局面一个字节的结果组成：
+
+    文件头  magic(8s) version(I) count(I) signature(16s)
+    结果    0 和棋，255 不合法的局面，其余为 距离 + 1，距离是到被将死（或困毙）的步数（半回合），
+            奇数表示轮到走棋的一方赢，偶数表示输
+
+局面的下标由每个棋子在它可以到达的格子中的序号按混合进制拼成，两方都从自己的视角计算，
+所以同一个文件既可以查红方走棋，也可以查黑方走棋。着法使用 elephantfish 的走法规则，
+没有合法着法时判负（困毙也算输）；长将、长捉等循环局面按和棋处理。
+
+    python tablebase.py KR-KAB KC-KA -o data/tablebase
+
+生成某个组合时，吃子以后得到的更小的组合也会一起生成。
+
+author: wzpan
+email: m@hahack.com
+"""
+
+import argparse
+import mmap
+import os
+import struct
+import time
+from array import array
+from functools import lru_cache
+from itertools import product
+from typing import Dict, List, Optional, Tuple
+
+import elephantfish
+from elephantfish import A0, MATE_UPPER, Position
+
+MAGIC = b"CCTB\0\0\0\0"
+VERSION = 1
+HEADER = struct.Struct("<8sII16s")
+
+DRAW = 0
+INVALID = 255
+MAX_DISTANCE = INVALID - 2
+
+# 签名中棋子的顺序
+PIECE_ORDER = "KRNCPAB"
+
+
+def _square(rank: int, fil: int) -> int:
+    return A0 - 16 * rank + fil
+
+
+# 每种棋子在己方视角下可以出现的格子，按格子下标从小到大排列
+SQUARES = {
+    "K": [_square(r, f) for r in range(3) for f in range(3, 6)],
+    "A": [_square(r, f) for r, f in ((0, 3), (0, 5), (1, 4), (2, 3), (2, 5))],
+    "B": [
+        _square(r, f)
+        for r, f in ((0, 2), (0, 6), (2, 0), (2, 4), (2, 8), (4, 2), (4, 6))
+    ],
+    "P": [_square(r, f) for r in (3, 4) for f in range(0, 9, 2)]
+    + [_square(r, f) for r in range(5, 10) for f in range(9)],
+}
+SQUARES["R"] = SQUARES["N"] = SQUARES["C"] = [
+    _square(r, f) for r in range(10) for f in range(9)
+]
+SQUARES = {p: sorted(squares) for p, squares in SQUARES.items()}
+SQUARE_INDEX = {
+    p: {square: index for index, square in enumerate(squares)}
+    for p, squares in SQUARES.items()
+}
+BOARD_SQUARES = SQUARES["R"]
+EMPTY = "".join(
+    "." if i in set(BOARD_SQUARES) else ("\n" if i % 16 == 15 else " ")
+    for i in range(256)
+)
+_STRIP = str.maketrans("", "", ". \n")
+
+
+def _sort_pieces(pieces: str) -> str:
+    return "".join(sorted(pieces, key=PIECE_ORDER.index))
+
+
+def make_signature(us: str, them: str) -> str:
+    """
+    子力签名，例如 ("KR", "KAB") -> "KR-KAB"
+
+    :param us: 轮到走棋的一方的棋子（大写）
+    :param them: 对方的棋子（大写）
+    """
+    return _sort_pieces(us) + "-" + _sort_pieces(them)
+
+
+def split_signature(signature: str) -> Tuple[str, str]:
+    us, them = signature.upper().split("-")
+    if us.count("K") != 1 or them.count("K") != 1:
+        raise ValueError("{} 双方都必须有且只有一个将帅".format(signature))
+    if set(us + them) - set(PIECE_ORDER):
+        raise ValueError("{} 包含未知的棋子".format(signature))
+    return _sort_pieces(us), _sort_pieces(them)
+
+
+class Layout:
+    """
+    一种子力组合的局面编号方式
+
+    局面用 (us, them) 两个元组表示，依次是每个棋子在己方视角下的格子，
+    同种棋子按格子从小到大排列。
+
+    :param signature: 子力签名
+    """
+
+    def __init__(self, signature: str):
+        self.us, self.them = split_signature(signature)
+        self.signature = make_signature(self.us, self.them)
+        self.pieces = self.us + self.them
+        self.radices = [len(SQUARES[p]) for p in self.pieces]
+        self.size = 1
+        for radix in self.radices:
+            self.size *= radix
+
+    def index(self, us: Tuple[int, ...], them: Tuple[int, ...]) -> int:
+        index = 0
+        for p, radix, square in zip(self.pieces, self.radices, us + them):
+            index = index * radix + SQUARE_INDEX[p][square]
+        return index
+
+    def canonical(self, squares: Tuple[int, ...], pieces: str) -> Tuple[int, ...]:
+        """同种棋子按格子排序"""
+        result, start = [], 0
+        while start < len(pieces):
+            end = start
+            while end < len(pieces) and pieces[end] == pieces[start]:
+                end += 1
+            result.extend(sorted(squares[start:end]))
+            start = end
+        return tuple(result)
+
+
+################################################################################
+# 生成
+################################################################################
+
+
+def _sub_signatures(signature: str) -> List[str]:
+    """吃掉一个子以后可能得到的组合（走棋方换成对方）"""
+    us, them = split_signature(signature)
+    subs = set()
+    for k, p in enumerate(them):
+        if p != "K":
+            subs.add(make_signature(them[:k] + them[k + 1 :], us))
+    return sorted(subs)
+
+
+class Generator:
+    """
+    逆向分析生成残局库
+
+    :param verbose: 是否打印进度
+    """
+
+    def __init__(self, verbose: bool = True):
+        self.values: Dict[str, bytes] = {}
+        self.verbose = verbose
+
+    def log(self, *args):
+        if self.verbose:
+            print(*args, flush=True)
+
+    def generate(self, signature: str) -> Dict[str, bytes]:
+        """
+        生成某个组合，以及它依赖的更小的组合
+
+        :return: {签名: 结果}
+        """
+        layout = Layout(signature)
+        if layout.signature in self.values:
+            return self.values
+        flipped = Layout(make_signature(layout.them, layout.us))
+        for sub in _sub_signatures(layout.signature) + _sub_signatures(
+            flipped.signature
+        ):
+            self.generate(sub)
+        start = time.time()
+        layouts = (
+            [layout] if layout.signature == flipped.signature else [layout, flipped]
+        )
+        for sig, values in zip((l.signature for l in layouts), self._solve(layouts)):
+            self.values[sig] = values
+        self.log(
+            "{} {} 个局面，用时 {:.1f} 秒".format(
+                " ".join(l.signature for l in layouts),
+                sum(l.size for l in layouts),
+                time.time() - start,
+            )
+        )
+        return self.values
+
+    def _capture_value(self, pieces: str, us, them, captured: int) -> int:
+        """吃子以后的局面（轮到对方走）在更小的组合里的结果"""
+        them_pieces = pieces[len(us) :]
+        child_us = them[:captured] + them[captured + 1 :]
+        child_us_pieces = them_pieces[:captured] + them_pieces[captured + 1 :]
+        us_pieces = pieces[: len(us)]
+        layout = _layout(make_signature(child_us_pieces, us_pieces))
+        child_us = layout.canonical(child_us, child_us_pieces)
+        child_them = layout.canonical(us, us_pieces)
+        return self.values[layout.signature][layout.index(child_us, child_them)]
+
+    def _solve(self, layouts: List[Layout]) -> List[bytes]:
+        # 第一遍：生成每个局面的着法，不吃子的着法记下子局面的编号，吃子的着法直接查小的组合
+        offsets = [0]
+        for l in layouts[:-1]:
+            offsets.append(offsets[-1] + l.size)
+        total = offsets[-1] + layouts[-1].size
+        other = {0: len(layouts) - 1, len(layouts) - 1: 0}
+
+        valid = bytearray(total)
+        edge_start = array("l", [0])
+        edges = array("l")
+        # 吃子的结果：能吃到输棋的最短距离、吃到赢棋的最长距离、能否吃成和棋
+        capture_win = {}
+        capture_loss = {}
+        capture_draw = set()
+        for t, layout in enumerate(layouts):
+            child_layout = layouts[other[t]]
+            child_offset = offsets[other[t]]
+            n_us = len(layout.us)
+            pieces = layout.pieces
+            node = offsets[t] - 1
+            for indices in product(*(range(r) for r in layout.radices)):
+                node += 1
+                squares = tuple(SQUARES[p][k] for p, k in zip(pieces, indices))
+                us, them = squares[:n_us], squares[n_us:]
+                if us != layout.canonical(us, layout.us) or them != layout.canonical(
+                    them, layout.them
+                ):
+                    edge_start.append(len(edges))
+                    continue
+                occupied = us + tuple(254 - s for s in them)
+                if len(set(occupied)) < len(occupied):
+                    edge_start.append(len(edges))
+                    continue
+                board = list(EMPTY)
+                for p, s in zip(pieces, occupied):
+                    board[s] = p
+                for s in occupied[n_us:]:
+                    board[s] = board[s].lower()
+                pos = Position("".join(board), 0)
+                moves = list(pos.gen_moves())
+                if not any(pos.board[j] == "k" for _, j in moves):
+                    valid[node] = 1
+                    self._expand(
+                        node,
+                        pos,
+                        moves,
+                        layout,
+                        us,
+                        them,
+                        child_layout,
+                        child_offset,
+                        edges,
+                        capture_win,
+                        capture_loss,
+                        capture_draw,
+                    )
+                edge_start.append(len(edges))
+        self.log("  {} 个合法局面，{} 个不吃子的着法".format(sum(valid), len(edges)))
+
+        # 第二遍：去掉走完以后会被吃将的着法，建立反向的边
+        pending = array("l", [0]) * total
+        parents_count = array("l", [0]) * (total + 1)
+        for node in range(total):
+            if not valid[node]:
+                continue
+            for e in range(edge_start[node], edge_start[node + 1]):
+                child = edges[e]
+                if valid[child]:
+                    pending[node] += 1
+                    parents_count[child + 1] += 1
+        for node in range(total):
+            parents_count[node + 1] += parents_count[node]
+        parents = array("l", [0]) * parents_count[total]
+        fill = array("l", parents_count)
+        for node in range(total):
+            if not valid[node]:
+                continue
+            for e in range(edge_start[node], edge_start[node + 1]):
+                child = edges[e]
+                if valid[child]:
+                    parents[fill[child]] = node
+                    fill[child] += 1
+        del edges, edge_start, fill
+
+        # 第三遍：按距离从小到大确定胜负
+        distance = array("h", [-1]) * total
+        max_loss = array("h", [0]) * total
+        win_pushed = bytearray(total)
+        buckets: List[List[Tuple[int, bool]]] = [[] for _ in range(MAX_DISTANCE + 1)]
+
+        def push(d, node, win):
+            if d <= MAX_DISTANCE:
+                buckets[d].append((node, win))
+
+        for node, d in capture_win.items():
+            win_pushed[node] = 1
+            push(d, node, True)
+        for node, d in capture_loss.items():
+            max_loss[node] = d
+        for node in range(total):
+            if (
+                valid[node]
+                and pending[node] == 0
+                and not win_pushed[node]
+                and node not in capture_draw
+            ):
+                push(max_loss[node], node, False)
+
+        for d, bucket in enumerate(buckets):
+            for node, win in bucket:
+                if distance[node] >= 0:
+                    continue
+                distance[node] = d
+                for k in range(parents_count[node], parents_count[node + 1]):
+                    parent = parents[k]
+                    if distance[parent] >= 0:
+                        continue
+                    if not win:
+                        if not win_pushed[parent]:
+                            win_pushed[parent] = 1
+                            push(d + 1, parent, True)
+                        continue
+                    pending[parent] -= 1
+                    if d + 1 > max_loss[parent]:
+                        max_loss[parent] = d + 1
+                    if (
+                        pending[parent] == 0
+                        and not win_pushed[parent]
+                        and parent not in capture_draw
+                    ):
+                        push(max_loss[parent], parent, False)
+            bucket.clear()
+
+        values = bytearray(total)
+        for node in range(total):
+            if not valid[node]:
+                values[node] = INVALID
+            elif distance[node] >= 0:
+                values[node] = distance[node] + 1
+        return [
+            bytes(values[offset : offset + layout.size])
+            for offset, layout in zip(offsets, layouts)
+        ]
+
+    def _expand(
+        self,
+        node,
+        pos,
+        moves,
+        layout,
+        us,
+        them,
+        child_layout,
+        child_offset,
+        edges,
+        capture_win,
+        capture_loss,
+        capture_draw,
+    ):
+        board = pos.board
+        slot = {s: k for k, s in enumerate(us)}
+        them_slot = {254 - s: k for k, s in enumerate(them)}
+        for i, j in moves:
+            k = slot[i]
+            moved = us[:k] + (j,) + us[k + 1 :]
+            if board[j] == ".":
+                child_them = child_layout.canonical(moved, layout.us)
+                edges.append(child_offset + child_layout.index(them, child_them))
+                continue
+            value = self._capture_value(layout.pieces, moved, them, them_slot[j])
+            if value == INVALID:
+                continue
+            if value == DRAW:
+                capture_draw.add(node)
+            elif value % 2:
+                # 吃完以后对方输，距离是偶数
+                d = value
+                if d < capture_win.get(node, MAX_DISTANCE + 1):
+                    capture_win[node] = d
+            else:
+                capture_loss[node] = max(capture_loss.get(node, 0), value)
+
+
+@lru_cache(maxsize=None)
+def _layout(signature: str) -> Layout:
+    return Layout(signature)
+
+
+def write_table(path: str, signature: str, values: bytes):
+    """
+    写残局库文件。先写临时文件再改名，正在读旧文件的进程不受影响
+    """
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(values), signature.encode()))
+        f.write(values)
+    os.replace(tmp, path)
+
+
+################################################################################
+# 查询
+################################################################################
+
+
+class TablebaseError(Exception):
+    pass
+
+
+class Table:
+    """
+    只读的单个残局库文件
+
+    :param path: 文件路径
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < HEADER.size:
+                raise TablebaseError("{} 不是残局库文件".format(path))
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, count, signature = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC:
+            raise TablebaseError("{} 不是残局库文件".format(path))
+        if version != VERSION:
+            raise TablebaseError(
+                "{} 的格式版本是 {}，当前支持的是 {}".format(path, version, VERSION)
+            )
+        self.layout = Layout(signature.rstrip(b"\0").decode())
+        if count != self.layout.size or HEADER.size + count > size:
+            raise TablebaseError("{} 不完整".format(path))
+
+    def __getitem__(self, index: int) -> int:
+        return self.mm[HEADER.size + index]
+
+    def close(self):
+        self.mm.close()
+
+
+class Tablebase:
+    """
+    一个目录下的全部残局库
+
+    :param directory: 残局库目录
+    """
+
+    def __init__(self, directory: str):
+        self.tables: Dict[str, Table] = {}
+        for name in sorted(os.listdir(directory)):
+            if name.endswith(".tb"):
+                table = Table(os.path.join(directory, name))
+                us, them = table.layout.us, table.layout.them
+                self.tables["".join(sorted(us)) + "-" + "".join(sorted(them))] = table
+        self.max_pieces = max(
+            (len(t.layout.pieces) for t in self.tables.values()), default=0
+        )
+        self.min_empty = 90 - self.max_pieces
+
+    def __len__(self):
+        return len(self.tables)
+
+    def probe(self, pos) -> Optional[int]:
+        """
+        查询局面的准确分数
+
+        :param pos: elephantfish.Position 局面
+        :return: 从轮到走棋的一方看的分数，赢棋接近 MATE_UPPER，输棋接近 -MATE_UPPER，
+            和棋为 0；没有对应的残局库或局面不合法时返回 None
+        """
+        board = pos.board
+        if board.count(".") < self.min_empty:
+            return None
+        pieces = board.translate(_STRIP)
+        key = (
+            "".join(sorted(p for p in pieces if p.isupper()))
+            + "-"
+            + "".join(sorted(p for p in pieces if p.islower())).upper()
+        )
+        table = self.tables.get(key)
+        if table is None:
+            return None
+        layout = table.layout
+        squares = {}
+        for s in BOARD_SQUARES:
+            p = board[s]
+            if p != ".":
+                if p.islower():
+                    p, s = p.upper() + "'", 254 - s
+                squares.setdefault(p, []).append(s)
+        try:
+            us = tuple(s for p in dict.fromkeys(layout.us) for s in sorted(squares[p]))
+            them = tuple(
+                s for p in dict.fromkeys(layout.them) for s in sorted(squares[p + "'"])
+            )
+            value = table[layout.index(us, them)]
+        except KeyError:
+            # 棋子在不可能出现的格子上，例如没过河的兵在奇数列
+            return None
+        if value == INVALID:
+            return None
+        if value == DRAW:
+            return 0
+        d = value - 1
+        return MATE_UPPER - d if d % 2 else -MATE_UPPER + d
+
+    def close(self):
+        for table in self.tables.values():
+            table.close()
+
+
+@lru_cache(maxsize=None)
+def open_tablebase(directory: str) -> Optional[Tablebase]:
+    """
+    打开残局库目录，同一个目录在进程内只映射一次
+
+    :param directory: 残局库目录
+    :return: 残局库，目录不存在或者没有残局库文件时返回 None
+    """
+    if not directory or not os.path.isdir(directory):
+        return None
+    tablebase = Tablebase(directory)
+    return tablebase if len(tablebase) else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="生成残局库")
+    parser.add_argument(
+        "signatures", nargs="+", help="子力签名，例如 KR-KAB 表示车帅对将士象"
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        default=os.path.join(
+            os.path.dirname(os.path.abspath(__file__)), "data", "tablebase"
+        ),
+        help="输出目录",
+    )
+    args = parser.parse_args()
+    os.makedirs(args.output, exist_ok=True)
+    generator = Generator()
+    for signature in args.signatures:
+        generator.generate(signature)
+    for signature, values in sorted(generator.values.items()):
+        write_table(os.path.join(args.output, signature + ".tb"), signature, values)
+        counts = [0, 0, 0]
+        for v in values:
+            if v != INVALID:
+                counts[0 if v == DRAW else 1 + v % 2] += 1
+        print(
+            "{:<10} 和 {:>9} 胜 {:>9} 负 {:>9}".format(
+                signature, counts[0], counts[1], counts[2]
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
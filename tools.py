@@ -1,9 +1,9 @@
 import itertools
-import re
 import time
 import sys
 
 import elephantfish
+import fen as fen_module
 
 ################################################################################
 # This module contains functions used by test.py and xboard.py.
@@ -20,7 +20,7 @@ FEN_INITIAL = "rnbakabnr/9/1c5c1/p1p1p1p1p/9/9/P1P1P1P1P/1C5C1/9/RNBAKABNR w - -
 def search(searcher, pos, secs, history=()):
     """This used to be in the Searcher class"""
     start = time.time()
-    for depth, move, score in searcher.search(pos, history):
+    for depth, move, score, _pv in searcher.search(pos, history):
         if time.time() - start > secs:
             break
     return move, score, depth
@@ -74,33 +74,13 @@ def get_color(pos):
 
 def parseFEN(fen):
     """Parses a string in Forsyth-Edwards Notation into a Position"""
-    board, color, _, __, ___, ____ = fen.split()
-    board = re.sub(r"\d", (lambda m: "." * int(m.group(0))), board)
-    board = list(
-        (16 * 3 + 3) * " " + "       ".join(board.split("/")) + (16 * 3 + 4) * " "
-    )
-    board[15::16] = ["\n"] * 16
-    # if color == 'w': board[::10] = ['\n']*12
-    # if color == 'b': board[9::10] = ['\n']*12
-    board = "".join(board)
-    score = sum(elephantfish.pst[p][i] for i, p in enumerate(board) if p.isupper())
-    score -= sum(
-        elephantfish.pst[p.upper()][254 - i] for i, p in enumerate(board) if p.islower()
-    )
-    pos = elephantfish.Position(board, score)
-    return pos if color == "w" else pos.rotate()
+    return fen_module.parse(fen)
 
 
 def renderFEN(pos, half_move_clock=0, full_move_clock=1):
-    color = "wb"[get_color(pos)]
-    if get_color(pos) == BLACK:
-        pos = pos.rotate()
-    board = "/".join(pos.board.split())
-    board = re.sub(r"\.+", (lambda m: str(len(m.group(0)))), board)
-    castling = "-"
-    ep = "-"
-    clock = "{} {}".format(half_move_clock, full_move_clock)
-    return " ".join((board, color, castling, ep, clock))
+    return fen_module.render(
+        pos, get_color(pos) == BLACK, half_move_clock, full_move_clock
+    )
 
 
 ################################################################################
@@ -109,17 +89,15 @@ def renderFEN(pos, half_move_clock=0, full_move_clock=1):
 
 
 def pv(searcher, pos, include_scores=True, include_loop=False):
+    """The principal variation of the last search from pos, as recorded by the
+    searcher's PV table"""
     res = []
     seen_pos = set()
     color = get_color(pos)
     origc = color
     if include_scores:
         res.append(str(pos.score))
-    while True:
-        move = searcher.tp_move.get(pos)
-        # The tp may have illegal moves, given lower depths don't detect king killing
-        if move is None or can_kill_king(pos.move(move)):
-            break
+    for move in searcher.pv:
         res.append(mrender(pos, move))
         pos, color = pos.move(move), 1 - color
         if pos in seen_pos:
@@ -169,6 +147,7 @@ def flatten_tree(tree, depth):
 # Non chess related tools
 ################################################################################
 
+
 # Disable buffering
 class Unbuffered(object):
     def __init__(self, stream):
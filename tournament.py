@@ -0,0 +1,368 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+tournament.py: 引擎对局赛
+
+让两个引擎从 data/fen/random_openings.fen 的开局局面开始对弈，每个开局双方各执红一次，
+在进程池里并行下棋，报告 Elo 差和 95% 置信区间，并用 SPRT 在结果足够明确时提前结束：
+
+    python tournament.py elephantfish algorithms.elephantfish_pvs --nodes 3000
+    python tournament.py elephantfish+pst_tuned elephantfish --time 0.5 --elo1 10
+
+引擎的写法是 `模块[+子力价值表模块]`：
+
+* 模块可以是模块名（`elephantfish`、`algorithms.elephantfish_improve`），
+  也可以是 .py 文件路径，例如保存下来的旧版本引擎，用来检查优化有没有损失棋力；
+* `+` 后面是 tuning.py 生成的子力价值表模块，会替换引擎的 `pst`，
+  引擎和子力价值表都相同的两个引擎互不影响。
+
+每步的预算是节点数（`--nodes`，与机器速度无关）或时间（`--time`）。
+algorithms 下的引擎不支持中途停止搜索，所以预算在每次加深后检查：
+搜索完一层以后超过预算就停止，所有引擎用同样的规则。
+
+SPRT 检验 H0: Elo 差 = elo0 和 H1: Elo 差 = elo1，对数似然比超出
+[log(beta / (1 - alpha)), log((1 - beta) / alpha)] 时结束。
+
+author: wzpan
+email: m@hahack.com
+"""
+import argparse
+import importlib
+import importlib.util
+import math
+import os
+import random
+import time
+from multiprocessing import Pool
+from typing import Dict, List, Optional, Tuple
+
+import tools
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# 超过这么多步判和
+MAX_PLIES = 300
+
+# 对局结果，从第一个引擎看
+WIN, DRAW, LOSS = 1.0, 0.5, 0.0
+
+
+################################################################################
+# 引擎
+################################################################################
+
+
+def _import(name: str, fresh: bool = False):
+    """
+    导入模块名或 .py 文件
+
+    :param fresh: 为 True 时导入一份独立的副本，修改它不影响其它引擎
+    """
+    if name.endswith(".py") or os.sep in name:
+        path = os.path.abspath(name)
+    elif fresh:
+        path = importlib.util.find_spec(name).origin
+    else:
+        return importlib.import_module(name)
+    module_name = "_engine_{}".format(abs(hash((path, fresh))))
+    spec = importlib.util.spec_from_file_location(module_name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def load_engine(spec: str):
+    """
+    按 `模块[+子力价值表模块]` 加载引擎
+
+    :return: 引擎模块
+    """
+    name, _, tables = spec.partition("+")
+    if not tables:
+        return _import(name)
+    module = _import(name, fresh=True)
+    tuned = _import(tables)
+    module.pst = {p: tuple(values) for p, values in tuned.pst.items()}
+    if hasattr(module, "make_pst_full"):
+        module.pst_full = module.make_pst_full(module.pst)
+    return module
+
+
+_engines: Dict[str, object] = {}
+
+
+def get_engine(spec: str):
+    """每个进程只加载一次"""
+    if spec not in _engines:
+        _engines[spec] = load_engine(spec)
+    return _engines[spec]
+
+
+def make_position(engine, board: str):
+    """
+    用引擎自己的 Position 和评估构造局面
+
+    :param board: 轮到走棋的一方在下的棋盘
+    """
+    if hasattr(engine, "evaluate"):
+        return engine.Position(board, engine.evaluate(board))
+    pst = engine.pst
+    score = sum(pst[p][i] for i, p in enumerate(board) if p.isupper())
+    score -= sum(pst[p.upper()][254 - i] for i, p in enumerate(board) if p.islower())
+    return engine.Position(board, score)
+
+
+class Deadline:
+    """
+    到时间以后 cancelled 为真，当作搜索的 cancel_token 使用
+
+    elephantfish 和 algorithms 下的变种每隔 CHECK_NODES 个节点检查一次，
+    所以各个引擎都在同样的时刻停下
+    """
+
+    def __init__(self, seconds: float):
+        self.at = time.time() + seconds
+
+    @property
+    def cancelled(self) -> bool:
+        return time.time() >= self.at
+
+
+def think(engine, searcher, pos, history, nodes=None, seconds=None):
+    """
+    在预算内搜索，返回 (着法, 分数)
+
+    和 ChessGame.think 一样，时间到了就在层中途停下，走最后搜完的那一层的着法
+
+    :param nodes: 节点数预算
+    :param seconds: 时间预算（秒）
+    """
+    move, score = None, 0
+    deadline = None if seconds is None else Deadline(seconds)
+    try:
+        for depth, move, score, _pv in searcher.search(pos, history):
+            if nodes is not None and searcher.nodes >= nodes:
+                break
+            if deadline is not None:
+                # 第一层总是算完，保证有着法可走；不支持 cancel_token 的旧引擎按层停下
+                if deadline.cancelled:
+                    break
+                searcher.cancel_token = deadline
+            if depth >= 100:
+                break
+    finally:
+        searcher.cancel_token = None
+    return move, score
+
+
+################################################################################
+# 对局
+################################################################################
+
+
+def play_game(task) -> Tuple[int, float, int]:
+    """
+    在子进程里下一局
+
+    :param task: (编号, 开局 FEN, 红方引擎, 黑方引擎, 节点数, 时间, 第一个引擎是否执红)
+    :return: (编号, 第一个引擎的得分, 步数)
+    """
+    index, fen, red, black, nodes, seconds, first_is_red = task
+    engines = [get_engine(red), get_engine(black)]
+    searchers = [engine.Searcher() for engine in engines]
+    start = tools.parseFEN(fen)
+    side = 0 if fen.split()[1] == "w" else 1
+    # 每个引擎各自维护局面和历史，着法 (i, j) 在所有引擎中的含义相同
+    positions = [make_position(engine, start.board) for engine in engines]
+    histories: List[List] = [[pos] for pos in positions]
+    seen = {start.board: 1}
+    result = DRAW
+    for _ in range(MAX_PLIES):
+        engine, pos = engines[side], positions[side]
+        legal = list(pos.gen_moves())
+        move, _score = think(
+            engine, searchers[side], pos, histories[side], nodes, seconds
+        )
+        # 不同引擎报告的分数不一定可靠，不按分数认输，被将死时下一步将帅会被吃掉
+        if not legal or move not in legal:
+            # 无棋可走（象棋里困毙也算输）
+            result = LOSS if side == 0 else WIN
+            break
+        captured = pos.board[move[1]]
+        positions = [p.move(move) for p in positions]
+        for history, p in zip(histories, positions):
+            history.append(p)
+        side = 1 - side
+        if captured == "k":
+            result = WIN if side == 1 else LOSS
+            break
+        board = positions[0].board
+        seen[board] = seen.get(board, 0) + 1
+        if seen[board] >= 3:
+            break
+    # result 是红方的得分
+    return index, result if first_is_red else 1 - result, len(histories[0]) - 1
+
+
+################################################################################
+# 统计
+################################################################################
+
+
+def score_to_elo(score: float) -> float:
+    score = min(max(score, 1e-6), 1 - 1e-6)
+    return -400 * math.log10(1 / score - 1)
+
+
+def elo_to_score(elo: float) -> float:
+    return 1 / (1 + 10 ** (-elo / 400))
+
+
+def elo(wins: int, draws: int, losses: int) -> Tuple[float, float]:
+    """
+    Elo 差和 95% 置信区间的半宽
+
+    :return: (Elo 差, 误差)
+    """
+    n = wins + draws + losses
+    if n == 0:
+        return 0.0, float("inf")
+    score = (wins + draws / 2) / n
+    variance = (
+        wins * (1 - score) ** 2 + draws * (0.5 - score) ** 2 + losses * score**2
+    ) / n
+    margin = 1.96 * math.sqrt(variance / n)
+    low, high = score_to_elo(score - margin), score_to_elo(score + margin)
+    return score_to_elo(score), (high - low) / 2
+
+
+def sprt_llr(wins: int, draws: int, losses: int, elo0: float, elo1: float) -> float:
+    """
+    SPRT 的对数似然比，用正态近似（与 fishtest 相同）
+
+    :param elo0: H0 的 Elo 差
+    :param elo1: H1 的 Elo 差
+    """
+    if wins + draws + losses == 0:
+        return 0.0
+    # 某种结果还没出现时方差会被低估（全胜时为 0），按出现半次估计
+    wins, draws, losses = (count or 0.5 for count in (wins, draws, losses))
+    n = wins + draws + losses
+    score = (wins + draws / 2) / n
+    variance = (
+        wins * (1 - score) ** 2 + draws * (0.5 - score) ** 2 + losses * score**2
+    ) / n
+    s0, s1 = elo_to_score(elo0), elo_to_score(elo1)
+    return n * (s1 - s0) * (2 * score - s0 - s1) / (2 * variance)
+
+
+def sprt_bounds(alpha: float, beta: float) -> Tuple[float, float]:
+    return math.log(beta / (1 - alpha)), math.log((1 - beta) / alpha)
+
+
+def run(args) -> Optional[str]:
+    """
+    进行对局赛
+
+    :return: SPRT 的结论，"H0"、"H1"，没有结论时为 None
+    """
+    with open(args.fen) as f:
+        openings = [line.strip() for line in f if line.strip()]
+    rng = random.Random(args.seed)
+    rng.shuffle(openings)
+    pairs = args.games // 2
+    tasks = []
+    for i in range(pairs):
+        fen = openings[i % len(openings)]
+        tasks.append((2 * i, fen, args.first, args.second, args.nodes, args.time, True))
+        tasks.append(
+            (2 * i + 1, fen, args.second, args.first, args.nodes, args.time, False)
+        )
+    lower, upper = sprt_bounds(args.alpha, args.beta)
+    wins = draws = losses = plies = 0
+    verdict = None
+    start = time.time()
+    print("{} vs {}，最多 {} 局".format(args.first, args.second, len(tasks)))
+    with Pool(args.workers) as pool:
+        for done, (_, result, length) in enumerate(
+            pool.imap_unordered(play_game, tasks), 1
+        ):
+            if result == WIN:
+                wins += 1
+            elif result == LOSS:
+                losses += 1
+            else:
+                draws += 1
+            plies += length
+            llr = sprt_llr(wins, draws, losses, args.elo0, args.elo1)
+            if llr <= lower:
+                verdict = "H0"
+            elif llr >= upper:
+                verdict = "H1"
+            if done % args.report == 0 or verdict or done == len(tasks):
+                diff, error = elo(wins, draws, losses)
+                print(
+                    "{:>5} 局 +{} ={} -{}  Elo {:+.1f} ± {:.1f}  "
+                    "LLR {:.2f} [{:.2f}, {:.2f}]  平均 {:.0f} 步  {:.0f} 秒".format(
+                        done,
+                        wins,
+                        draws,
+                        losses,
+                        diff,
+                        error,
+                        llr,
+                        lower,
+                        upper,
+                        plies / done,
+                        time.time() - start,
+                    ),
+                    flush=True,
+                )
+            if verdict:
+                pool.terminate()
+                break
+    if verdict == "H1":
+        print(
+            "SPRT 接受 H1：{} 比 {} 强至少 {} Elo".format(
+                args.first, args.second, args.elo1
+            )
+        )
+    elif verdict == "H0":
+        print(
+            "SPRT 接受 H0：{} 没有比 {} 强 {} Elo".format(
+                args.first, args.second, args.elo1
+            )
+        )
+    else:
+        print("SPRT 没有结论")
+    return verdict
+
+
+def main():
+    parser = argparse.ArgumentParser(description="引擎对局赛")
+    parser.add_argument("first", help="第一个引擎，Elo 差从它看")
+    parser.add_argument("second", help="第二个引擎")
+    budget = parser.add_mutually_exclusive_group()
+    budget.add_argument("--nodes", type=int, default=None, help="每步的节点数")
+    budget.add_argument("--time", type=float, default=None, help="每步的时间（秒）")
+    parser.add_argument("--games", type=int, default=2000, help="最多下多少局")
+    parser.add_argument("--elo0", type=float, default=0.0, help="SPRT H0 的 Elo 差")
+    parser.add_argument("--elo1", type=float, default=20.0, help="SPRT H1 的 Elo 差")
+    parser.add_argument("--alpha", type=float, default=0.05)
+    parser.add_argument("--beta", type=float, default=0.05)
+    parser.add_argument(
+        "--fen",
+        default=os.path.join(HERE, "data", "fen", "random_openings.fen"),
+        help="开局局面文件",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="打乱开局的随机种子")
+    parser.add_argument("--report", type=int, default=20, help="每多少局报告一次")
+    parser.add_argument("--workers", type=int, default=None, help="进程数")
+    args = parser.parse_args()
+    if args.nodes is None and args.time is None:
+        args.nodes = 3000
+    run(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,472 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+tuning.py: 子力价值表调参
+
+用 Texel 方法调整子力价值和子力价值表：对一批已知胜负的局面，让
+`sigmoid(K * 评估分数)` 尽量接近对局结果，用梯度下降最小化均方误差。
+评估分数对子力价值表是线性的，所以每个局面只需要记下棋盘上每个棋子对应的表项，
+整批局面用 NumPy 一次算出分数和梯度；多个进程各算一部分局面的梯度再相加。
+
+局面文件每行一个 FEN 加对局结果（从红方看），结果可以是 `1-0`、`0-1`、`1/2-1/2` 或 0 到 1 之间的小数：
+
+    rnbakabnr/9/1c5c1/p1p1p1p1p/9/9/P1P1P1P1P/1C5C1/9/RNBAKABNR w - - 0 1 1/2-1/2
+
+也可以直接读 gamelog.py 记录的棋谱文件（.pgn、.pgn.gz）或棋谱目录，
+取每局开局以后的平稳局面，标上这局的结果。没有现成的对局记录时可以先自对弈生成：
+
+    python tuning.py selfplay -o data/labelled.txt --games 2000 --nodes 2000
+    python tuning.py fit data/labelled.txt -o pst_tuned.py
+
+`fit` 生成的模块包含和 elephantfish.py 相同格式的 `piece` 和 `pst`，其中
+士和将的表也是单独调出来的，将的表已经加上了将的子力价值。elephantfish.py
+在定义完表以后会用象的表覆盖士的表、用兵的表重算将的表，所以生成的模块
+不能直接粘贴进去，要通过 tournament.py 的 `引擎+子力价值表模块` 加载，
+和原来的表对比强弱。
+
+author: wzpan
+email: m@hahack.com
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+from multiprocessing import Pool
+from typing import Iterator, List, Optional, Tuple
+
+import numpy as np
+
+import batch
+import elephantfish
+import gamelog
+from batch import BOARD_SQUARES, PIECES
+from fen import parse as parse_fen
+from fen import render as render_fen
+
+# 每个局面最多 32 个棋子
+MAX_PIECES = 32
+# 参数：7 种棋子 × 90 个格子的表项，最后一个是空位（始终为 0）
+N_ENTRIES = len(PIECES) * 90
+PAD = N_ENTRIES
+
+RESULTS = {"1-0": 1.0, "0-1": 0.0, "1/2-1/2": 0.5}
+# 从棋谱取局面时跳过开局的步数
+OPENING_PLIES = 8
+
+
+################################################################################
+# 读取局面
+################################################################################
+
+
+def features(codes: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    把局面编码转成线性模型的特征
+
+    :param codes: `batch` 的 `(N, 256)` 编码
+    :return: (index, sign)，都是 `(N, 32)`。index 是每个棋子对应的表项，
+        己方棋子按自己的格子、对方棋子按对称的格子；sign 己方为 1，对方为 -1，空位为 0
+    """
+    squares = codes[:, BOARD_SQUARES].astype(np.int16)
+    k = np.arange(90, dtype=np.int16)
+    index = np.where(
+        squares > 0,
+        (squares - 1) * 90 + k,
+        np.where(squares < 0, (-squares - 1) * 90 + 89 - k, PAD),
+    )
+    sign = np.sign(squares).astype(np.int8)
+    # 把有棋子的格子排到前面，只保留 32 个
+    order = np.argsort(sign == 0, axis=1, kind="stable")[:, :MAX_PIECES]
+    index = np.take_along_axis(index, order, axis=1).astype(np.int16)
+    sign = np.take_along_axis(sign, order, axis=1)
+    return index, sign
+
+
+def parse_labelled(
+    lines: List[str],
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    解析一批带结果的局面
+
+    :return: (index, sign, offset, result)。offset 是评估中子力价值表以外的部分，
+        调参时保持不变；result 是从轮到走棋的一方看的结果
+    """
+    fens, results = [], []
+    for line in lines:
+        fen, result = line.rsplit(None, 1)
+        fens.append(fen)
+        results.append(RESULTS[result] if result in RESULTS else float(result))
+    codes, colors = batch.parse_fens(fens)
+    boards = [parse_fen(fen) for fen in fens]
+    offset = np.array([pos.score for pos in boards], dtype=np.int32)
+    offset -= batch.pst_scores(codes)
+    results = np.array(results, dtype=np.float32)
+    results = np.where(colors == 1, 1 - results, results)
+    index, sign = features(codes)
+    return index, sign, offset, results
+
+
+def game_samples(game: gamelog.Game) -> Iterator[str]:
+    """
+    从一局棋谱中取带结果的平稳局面
+    """
+    black = game.fen.split()[1] == "b"
+    for ply, (pos, _move) in enumerate(game.replay()):
+        if ply >= OPENING_PLIES and is_quiet(pos):
+            yield "{} {}".format(render_fen(pos, black), game.result)
+        black = not black
+
+
+def iter_lines(paths: List[str]) -> Iterator[str]:
+    for path in paths:
+        if gamelog.is_game_file(path):
+            for game in gamelog.iter_games(path):
+                if game.result in RESULTS:
+                    yield from game_samples(game)
+            continue
+        with open(path) as f:
+            for line in f:
+                line = line.strip()
+                if line and not line.startswith("#"):
+                    yield line
+
+
+def iter_chunks(paths: List[str], size: int) -> Iterator[List[str]]:
+    lines = []
+    for line in iter_lines(paths):
+        lines.append(line)
+        if len(lines) >= size:
+            yield lines
+            lines = []
+    if lines:
+        yield lines
+
+
+def load(paths: List[str], workers: Optional[int], limit: Optional[int] = None):
+    """
+    用多个进程读取并解析局面文件
+
+    :return: parse_labelled 的结果，已经拼接成整个数据集
+    """
+    parts = []
+    count = 0
+    with Pool(workers) as pool:
+        for part in pool.imap(parse_labelled, iter_chunks(paths, 10000)):
+            parts.append(part)
+            count += len(part[0])
+            if limit and count >= limit:
+                break
+    if not parts:
+        raise SystemExit("没有读到局面")
+    return [np.concatenate(columns)[:limit] for columns in zip(*parts)]
+
+
+################################################################################
+# 拟合
+################################################################################
+
+# 子进程里的数据集，通过 np.load 的 mmap 共享，不需要复制
+_data = None
+
+
+def _init_worker(directory: str):
+    global _data
+    _data = [
+        np.load(os.path.join(directory, name + ".npy"), mmap_mode="r")
+        for name in ("index", "sign", "offset", "result")
+    ]
+
+
+def _shard(args) -> Tuple[float, np.ndarray]:
+    """一部分局面的误差之和，以及对每个表项的梯度之和"""
+    start, end, table, k = args
+    index, sign, offset, result = (column[start:end] for column in _data)
+    sign = sign.astype(np.float64)
+    score = (table[index] * sign).sum(axis=1) + offset
+    p = 1 / (1 + np.exp(-k * score))
+    error = result - p
+    g = -2 * error * p * (1 - p) * k
+    grad = np.bincount(
+        index.ravel(), weights=(g[:, None] * sign).ravel(), minlength=N_ENTRIES + 1
+    )
+    return float((error**2).sum()), grad[:N_ENTRIES]
+
+
+class Tuner:
+    """
+    在整个数据集上算误差和梯度
+
+    :param data: load 的结果
+    :param workers: 进程数
+    """
+
+    def __init__(self, data, workers: Optional[int]):
+        self.n = len(data[0])
+        self.tmp = tempfile.TemporaryDirectory()
+        for name, column in zip(("index", "sign", "offset", "result"), data):
+            np.save(os.path.join(self.tmp.name, name + ".npy"), column)
+        workers = workers or os.cpu_count()
+        step = -(-self.n // workers)
+        self.shards = [(i, min(i + step, self.n)) for i in range(0, self.n, step)]
+        self.pool = Pool(workers, _init_worker, (self.tmp.name,))
+
+    def evaluate(self, entries: np.ndarray, k: float) -> Tuple[float, np.ndarray]:
+        """
+        :param entries: 长度为 N_ENTRIES 的表项
+        :return: (均方误差, 梯度)
+        """
+        table = np.append(entries, 0.0)
+        loss, grad = 0.0, np.zeros(N_ENTRIES)
+        for l, g in self.pool.map(_shard, [(s, e, table, k) for s, e in self.shards]):
+            loss += l
+            grad += g
+        return loss / self.n, grad / self.n
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        self.tmp.cleanup()
+
+
+def initial_entries() -> np.ndarray:
+    """elephantfish 当前的子力价值表，按 features 的顺序排列"""
+    tables = batch.default_tables()
+    return np.concatenate([tables[code, BOARD_SQUARES] for code in range(1, 8)]).astype(
+        np.float64
+    )
+
+
+def fit_k(tuner: Tuner, entries: np.ndarray) -> float:
+    """找使当前表误差最小的缩放系数 K"""
+    best = None
+    for k in np.geomspace(1e-4, 1e-1, 31):
+        loss, _ = tuner.evaluate(entries, k)
+        if best is None or loss < best[0]:
+            best = loss, k
+    lo, hi = best[1] / 1.3, best[1] * 1.3
+    for _ in range(10):
+        m1, m2 = lo + (hi - lo) / 3, hi - (hi - lo) / 3
+        if tuner.evaluate(entries, m1)[0] < tuner.evaluate(entries, m2)[0]:
+            hi = m2
+        else:
+            lo = m1
+    return (lo + hi) / 2
+
+
+def fit(
+    tuner: Tuner,
+    entries: np.ndarray,
+    k: float,
+    epochs: int,
+    lr: float,
+    l2: float,
+    log_every: int = 10,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    用 Adam 调整表项
+
+    每种棋子的 90 个表项可以整体平移（即子力价值），也可以各自调整（即位置分）；
+    位置分的调整量有 L2 正则，避免出现次数很少的格子被调得离谱。
+
+    :param entries: 初始表项
+    :param k: 缩放系数
+    :param epochs: 迭代次数
+    :param lr: 学习率（分）
+    :param l2: 位置分调整量的正则系数
+    """
+    n_pieces = len(PIECES)
+    base = np.zeros(n_pieces)
+    delta = np.zeros(N_ENTRIES)
+    params = np.concatenate([base, delta])
+    m = np.zeros_like(params)
+    v = np.zeros_like(params)
+    king = PIECES.index("K")
+    for epoch in range(1, epochs + 1):
+        base, delta = params[:n_pieces], params[n_pieces:]
+        current = entries + np.repeat(base, 90) + delta
+        loss, grad = tuner.evaluate(current, k)
+        grad_base = grad.reshape(n_pieces, 90).sum(axis=1)
+        # 双方各有一个将帅，将帅的子力价值不影响分数，固定不动
+        grad_base[king] = 0
+        grad = np.concatenate([grad_base, grad + 2 * l2 * delta])
+        m = 0.9 * m + 0.1 * grad
+        v = 0.999 * v + 0.001 * grad**2
+        m_hat = m / (1 - 0.9**epoch)
+        v_hat = v / (1 - 0.999**epoch)
+        params = params - lr * m_hat / (np.sqrt(v_hat) + 1e-12)
+        if epoch % log_every == 0 or epoch == epochs:
+            print("epoch {:>5} 误差 {:.6f}".format(epoch, loss), flush=True)
+    base, delta = params[:n_pieces], params[n_pieces:]
+    return entries + np.repeat(base, 90) + delta, base
+
+
+def write_module(path: str, entries: np.ndarray, base: np.ndarray, comment: str):
+    """
+    生成子力价值表模块，格式与 elephantfish.py 中的 piece 和 pst 相同
+
+    pst 是最终使用的表，由 tournament.py 的 `+子力价值表模块` 直接加载，
+    不经过 elephantfish.py 对士和将的表的改写
+    """
+    tables = np.zeros((len(PIECES), 256), dtype=np.int64)
+    tables[:, BOARD_SQUARES] = np.rint(entries).reshape(len(PIECES), 90)
+    lines = [
+        "# -*- coding: utf-8 -*-",
+        "# 由 tuning.py 生成，请不要手工修改",
+        "# " + comment,
+        "",
+        "piece = {",
+    ]
+    for p, shift in zip(PIECES, base):
+        lines.append(
+            '    "{}": {},'.format(p, elephantfish.piece[p] + int(round(shift)))
+        )
+    lines += ["}", "", "pst = {"]
+    for p, table in zip(PIECES, tables):
+        lines.append('    "{}": ('.format(p))
+        for row in range(16):
+            values = table[row * 16 : row * 16 + 16]
+            lines.append("        " + " ".join("{},".format(x) for x in values))
+        lines.append("    ),")
+    lines += ["}", ""]
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        f.write("\n".join(lines))
+    os.replace(tmp, path)
+
+
+def cmd_fit(args):
+    start = time.time()
+    data = load(args.inputs, args.workers, args.limit)
+    print("读入 {} 个局面，用时 {:.1f} 秒".format(len(data[0]), time.time() - start))
+    tuner = Tuner(data, args.workers)
+    try:
+        entries = initial_entries()
+        k = args.k or fit_k(tuner, entries)
+        before, _ = tuner.evaluate(entries, k)
+        print("K = {:.6f}，初始误差 {:.6f}".format(k, before))
+        tuned, base = fit(tuner, entries, k, args.epochs, args.lr, args.l2)
+        after, _ = tuner.evaluate(tuned, k)
+    finally:
+        tuner.close()
+    comment = "{} 个局面，K = {:.6f}，误差 {:.6f} -> {:.6f}".format(
+        len(data[0]), k, before, after
+    )
+    write_module(args.output, tuned, base, comment)
+    print(
+        "{}，用时 {:.1f} 秒，写入 {}".format(comment, time.time() - start, args.output)
+    )
+
+
+################################################################################
+# 自对弈
+################################################################################
+
+
+def is_quiet(pos: elephantfish.Position) -> bool:
+    """没有可以吃的子，静态评估比较可信"""
+    return not any(pos.board[j].islower() for _, j in pos.gen_moves())
+
+
+def selfplay_game(task) -> List[str]:
+    """
+    从一个开局局面自对弈一局
+
+    :param task: (FEN, 每步节点数, 随机种子, 最多步数)
+    :return: 带结果的局面行
+    """
+    fen, nodes, seed, max_plies = task
+    rng = random.Random(seed)
+    pos = parse_fen(fen)
+    black = fen.split()[1] == "b"
+    history, samples = [], []
+    # 超过步数或重复局面判和
+    result = "1/2-1/2"
+    for ply in range(max_plies):
+        if is_quiet(pos):
+            samples.append(render_fen(pos, black))
+        history.append(pos)
+        searcher = elephantfish.Searcher()
+        move, score = None, 0
+        for _depth, move, score, _pv in searcher.search(pos, history, nodes):
+            pass
+        if move is None or score <= -elephantfish.MATE_LOWER:
+            # 轮到走棋的一方认输
+            result = "1-0" if black else "0-1"
+            break
+        # 开局时偶尔走一步随机的棋，让对局更多样
+        if ply < 8 and rng.random() < 0.2:
+            move = rng.choice(list(pos.gen_moves()))
+        pos = pos.move(move)
+        black = not black
+        if history.count(pos) >= 2:
+            break
+    return ["{} {}".format(fen, result) for fen in samples]
+
+
+def cmd_selfplay(args):
+    with open(args.fen) as f:
+        openings = [line.strip() for line in f if line.strip()]
+    rng = random.Random(args.seed)
+    tasks = [
+        (rng.choice(openings), args.nodes, rng.getrandbits(32), args.max_plies)
+        for _ in range(args.games)
+    ]
+    start = time.time()
+    positions = 0
+    with Pool(args.workers) as pool, open(args.output, "a") as out:
+        for done, lines in enumerate(pool.imap_unordered(selfplay_game, tasks), 1):
+            out.writelines(line + "\n" for line in lines)
+            positions += len(lines)
+            if done % 10 == 0 or done == len(tasks):
+                print(
+                    "{}/{} 局，{} 个局面，{:.0f} 秒".format(
+                        done, len(tasks), positions, time.time() - start
+                    ),
+                    flush=True,
+                )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="子力价值表调参")
+    parser.add_argument("--workers", type=int, default=None, help="进程数")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    selfplay = subparsers.add_parser("selfplay", help="自对弈生成带结果的局面")
+    selfplay.add_argument("-o", "--output", default="labelled.txt")
+    selfplay.add_argument(
+        "--fen",
+        default=os.path.join(
+            os.path.dirname(os.path.abspath(__file__)),
+            "data",
+            "fen",
+            "random_openings.fen",
+        ),
+        help="开局局面文件",
+    )
+    selfplay.add_argument("--games", type=int, default=100)
+    selfplay.add_argument("--nodes", type=int, default=2000, help="每步的节点数")
+    selfplay.add_argument("--max-plies", type=int, default=200, help="超过即判和")
+    selfplay.add_argument("--seed", type=int, default=0)
+    selfplay.set_defaults(func=cmd_selfplay)
+
+    fit_parser = subparsers.add_parser("fit", help="调参并生成子力价值表模块")
+    fit_parser.add_argument(
+        "inputs", nargs="+", help="带结果的局面文件，或者棋谱文件和目录"
+    )
+    fit_parser.add_argument("-o", "--output", default="pst_tuned.py")
+    fit_parser.add_argument("--limit", type=int, default=None, help="最多读取的局面数")
+    fit_parser.add_argument("--epochs", type=int, default=300)
+    fit_parser.add_argument("--lr", type=float, default=1.0, help="学习率（分）")
+    fit_parser.add_argument("--l2", type=float, default=1e-7, help="位置分的正则系数")
+    fit_parser.add_argument(
+        "--k", type=float, default=None, help="缩放系数，默认自动拟合"
+    )
+    fit_parser.set_defaults(func=cmd_fit)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()